@@ -1,17 +1,91 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+import logging
 import os
 
 db = SQLAlchemy()
 login_manager = LoginManager()
+logger = logging.getLogger(__name__)
+apps_created = 0
+
+def create_app(config_name=None):
+    global apps_created
+    from app.startup import StartupTimer
+    timer = StartupTimer()
+    if not apps_created:
+        timer.add('import', timer.started - IMPORT_STARTED)
+    apps_created += 1
 
-def create_app():
     app = Flask(__name__)
-    app.config['SECRET_KEY'] = 'your-secret-key'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///can  .db'
+    app.config['APP_CONFIG'] = config_name or os.environ.get('APP_CONFIG', 'development')
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///can  .db')
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static/uploads')
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+    app.config['NOTIFICATION_FANOUT_ASYNC'] = os.environ.get('NOTIFICATION_FANOUT_ASYNC') == '1'
+    app.config['NOTIFICATION_FANOUT_WORKERS'] = 2
+    app.config['NOTIFICATION_FANOUT_QUEUE_SIZE'] = 1000
+    app.config['UNREAD_CACHE_SIZE'] = 10000
+    app.config['UNREAD_CACHE_TTL'] = 60
+    app.config['MEDIA_PROCESSING_ASYNC'] = os.environ.get('MEDIA_PROCESSING_ASYNC', '1') == '1'
+    app.config['MEDIA_WORKERS'] = 2
+    app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+    app.config['PAGE_CACHE_BACKEND'] = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+    app.config['PAGE_CACHE_DIR'] = os.path.join(app.instance_path, 'page_cache')
+    app.config['PAGE_CACHE_TTL'] = 300
+    app.config['PAGE_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+    app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('INSTRUMENTATION_ENABLED') == '1'
+    app.config['INSTRUMENTATION_SLOW_REQUEST_SECONDS'] = 1.0
+    app.config['INSTRUMENTATION_N_PLUS_ONE_THRESHOLD'] = 10
+    app.config['INSTRUMENTATION_PROFILE_SAMPLE_RATE'] = float(os.environ.get('INSTRUMENTATION_PROFILE_SAMPLE_RATE', '0'))
+    app.config['INSTRUMENTATION_PROFILE_DIR'] = os.path.join(app.instance_path, 'profiles')
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['MESSAGE_POLL_TIMEOUT'] = 10
+    # Leave one thread per process free for pages; WEB_THREADS should match --threads
+    app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', '4'))
+    app.config['MESSAGE_POLL_MAX_WAITERS'] = int(os.environ.get('MESSAGE_POLL_MAX_WAITERS',
+                                                                max(app.config['WEB_THREADS'] - 1, 1)))
+    app.config['MESSAGE_SIGNAL_DIR'] = os.path.join(app.instance_path, 'message_signals')
+    app.config['MESSAGE_SIGNAL_INTERVAL'] = 1.0
+    app.config['SUGGESTIONS_CACHE_BACKEND'] = os.environ.get('SUGGESTIONS_CACHE_BACKEND', 'memory')
+    app.config['SUGGESTIONS_CACHE_DIR'] = os.path.join(app.instance_path, 'suggestions_cache')
+    app.config['SUGGESTIONS_CACHE_SIZE'] = 10000
+    app.config['SUGGESTIONS_CACHE_TTL'] = 3600
+    app.config['SUGGESTIONS_CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+    app.config['SESSION_USER_CACHE_SIZE'] = 10000
+    app.config['SESSION_USER_CACHE_TTL'] = 30
+    app.config['PASSWORD_HASH_WORKERS'] = 2
+    app.config['PASSWORD_HASH_QUEUE_SIZE'] = 16
+    app.config['PASSWORD_HASH_TIMEOUT'] = 10
+    # Reverse proxies in front of the app whose X-Forwarded-For/-Proto headers are trusted
+    app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', '0'))
+    app.config['LOGIN_RATE_LIMIT_IP_BURST'] = 20
+    app.config['LOGIN_RATE_LIMIT_IP_PER_MINUTE'] = 20
+    app.config['LOGIN_RATE_LIMIT_ACCOUNT_BURST'] = 5
+    app.config['LOGIN_RATE_LIMIT_ACCOUNT_PER_MINUTE'] = 5
+    app.config['PURGE_INLINE_ROWS'] = 2000
+    app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE', '1') == '1'
+    app.config['JINJA_BYTECODE_CACHE_DIR'] = os.path.join(app.instance_path, 'jinja_cache')
+    app.config['TEMPLATE_WARMUP'] = False
+
+    if app.config['APP_CONFIG'] == 'production':
+        from app.database import PRODUCTION_ENGINE_OPTIONS, PRODUCTION_SQLITE_PRAGMAS
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = PRODUCTION_ENGINE_OPTIONS
+        app.config['SQLITE_PRAGMAS'] = PRODUCTION_SQLITE_PRAGMAS
+        # Deploys run `flask migrate` once instead of every worker checking the schema as it starts
+        app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE') == '1'
+        app.config['TEMPLATE_WARMUP'] = True
+        # Tag versions in memory are per process, so one worker's writes wouldn't reach the others' pages
+        app.config['PAGE_CACHE_BACKEND'] = os.environ.get('PAGE_CACHE_BACKEND', 'disk')
+        # Shared so a follow in one worker reaches the others and recompute-suggestions can warm it
+        app.config['SUGGESTIONS_CACHE_BACKEND'] = os.environ.get('SUGGESTIONS_CACHE_BACKEND', 'disk')
+        # Production runs behind nginx; without this every login shares the proxy's IP limit
+        app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', '1'))
+    timer.mark('config')
 
     from datetime import datetime
     from flask import Markup
@@ -40,14 +114,21 @@ def create_app():
 
         return default
 
+    if app.config['PROXY_FIX_X_FOR']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'],
+                                x_proto=app.config['PROXY_FIX_X_FOR'])
+
     db.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
 
-    from app.models import User
+    timer.mark('extensions')
+
+    from app.accounts import load_session_user
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return load_session_user(int(user_id))
 
     from app.routes import main
     from app.auth import auth
@@ -55,8 +136,63 @@ def create_app():
     app.register_blueprint(auth)
 
     app.jinja_env.filters['time_since'] = time_since
+    from app.storage import upload_url
+    app.jinja_env.globals['upload_url'] = upload_url
+    from app.assets import init_assets
+    init_assets(app)
+
+    from app.instrumentation import init_instrumentation
+    init_instrumentation(app)
+
+    from app.commands import register_commands
+    register_commands(app)
+    timer.mark('blueprints')
 
     with app.app_context():
-        db.create_all()
+        from app.database import configure_engine
+        configure_engine(app)
+        from app.migrations import check_schema
+        check_schema(app)
+        from app.search import search_index_exists
+        app.extensions['search_fts'] = search_index_exists()
+        # Don't hold connections from startup work into forked workers
+        db.engine.dispose()
+    timer.mark('schema')
+
+    from app.startup import init_template_cache, warm_templates
+    init_template_cache(app)
+    if app.config['TEMPLATE_WARMUP']:
+        warm_templates(app)
+        timer.mark('templates')
+
+    from app.accounts import init_accounts
+    init_accounts(app)
+
+    from app.badges import init_badges
+    init_badges(app)
+
+    from app.page_cache import init_page_cache
+    init_page_cache(app)
+
+    from app.messaging import init_messaging
+    init_messaging(app)
+
+    from app.suggestions import init_suggestions
+    init_suggestions(app)
+
+    from app.fanout import init_fanout
+    init_fanout(app)
+
+    from app.media import init_media
+    init_media(app)
+
+    from app.storage import init_sweeper
+    init_sweeper(app)
+
+    from app.purge import init_purge
+    init_purge(app)
+    timer.mark('services')
 
+    app.extensions['startup_timer'] = timer
+    logger.info(timer.report())
     return app
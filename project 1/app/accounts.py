@@ -0,0 +1,179 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import current_app
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from werkzeug.security import check_password_hash, generate_password_hash
+from app import db
+from app.cache import LRUCache
+from app.models import User
+
+logger = logging.getLogger(__name__)
+
+PASSWORD_METHOD = 'pbkdf2:sha256'
+# Role given to accounts being purged, which can no longer log in or use their sessions
+DISABLED_ROLE = 'Deleted'
+
+class LoginThrottled(Exception):
+    """Raised when a login attempt is refused before the password is checked."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Session users. Flask-Login calls load_user on every authenticated request;
+# pages only read plain columns from current_user, so a detached snapshot
+# is cached for a few seconds instead of querying the user row each time.
+# The cache is per process: other workers see changes once the TTL expires.
+
+class SessionUser(UserMixin):
+    """Read-only copy of a User row, without the password hash."""
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return f"SessionUser('{self.username}', '{self.role}')"
+
+SESSION_COLUMNS = tuple(column.key for column in User.__table__.columns if column.key != 'password')
+
+def load_session_user(user_id):
+    cache = current_app.extensions.get('session_user_cache')
+    values = cache.get(user_id) if cache is not None else None
+    if values is None:
+        row = db.session.query(*(getattr(User, key) for key in SESSION_COLUMNS)).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        values = dict(zip(SESSION_COLUMNS, row))
+        if cache is not None:
+            cache.set(user_id, values)
+    if values['role'] == DISABLED_ROLE:
+        return None
+    return SessionUser(values)
+
+def invalidate_session_user(*user_ids):
+    cache = current_app.extensions.get('session_user_cache')
+    if cache is not None:
+        for user_id in user_ids:
+            cache.delete(user_id)
+
+def record_user_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('session_user_ids', set()).add(target.id)
+
+for event_name in ('after_update', 'after_delete'):
+    event.listen(User, event_name, record_user_change)
+
+@event.listens_for(db.session, 'after_commit')
+def drop_committed_users(session):
+    user_ids = session.info.pop('session_user_ids', None)
+    if user_ids:
+        invalidate_session_user(*user_ids)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_pending_users(session):
+    session.info.pop('session_user_ids', None)
+
+class PasswordHasher:
+    """
+    Runs password hashing on a small thread pool so a burst of logins uses
+    at most `workers` cores. hashlib releases the GIL while hashing. At most
+    queue_size attempts wait for a worker; beyond that check() raises
+    LoginThrottled at once instead of tying up the request thread. An
+    attempt still waiting after timeout seconds is cancelled and raises
+    LoginThrottled too.
+    """
+
+    def __init__(self, workers=2, queue_size=16, timeout=10):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.timeout = timeout
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            logger.warning("Password hashing pool is full, refusing attempt")
+            raise LoginThrottled('The server is busy, please try again in a moment.', retry_after=2)
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning(f"Password hashing took longer than {self.timeout}s, refusing attempt")
+            raise LoginThrottled('The server is busy, please try again in a moment.', retry_after=5)
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, PASSWORD_METHOD)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def check_password(password_hash, password):
+    return current_app.extensions['password_hasher'].check(password_hash, password)
+
+def hash_password(password):
+    return current_app.extensions['password_hasher'].hash(password)
+
+class RateLimiter:
+    """
+    Token buckets keyed by any string. Each key starts with `capacity`
+    tokens and regains `rate` per second. Idle buckets age out of an LRU
+    cache, which also bounds memory under a spray of distinct keys.
+    """
+
+    def __init__(self, capacity, rate, maxsize=100000):
+        self.capacity = capacity
+        self.rate = rate
+        # An idle bucket is full again after capacity / rate seconds
+        self.buckets = LRUCache(maxsize=maxsize, ttl=max(1, int(capacity / rate) + 1))
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        """Spends a token for key. Returns 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key) or (self.capacity, now)
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets.set(key, (tokens, now))
+                return (1 - tokens) / self.rate
+            self.buckets.set(key, (tokens - 1, now))
+            return 0
+
+def throttle_login(ip, email):
+    """Raises LoginThrottled when ip or the account behind email has used up its login attempts."""
+    limiters = current_app.extensions['login_rate_limiters']
+    for name, key in (('ip', ip), ('account', (email or '').strip().lower())):
+        wait = limiters[name].take(key)
+        if wait:
+            logger.warning(f"Login attempts throttled for {name} {key}")
+            raise LoginThrottled('Too many login attempts. Please wait a moment and try again.',
+                                 retry_after=int(wait) + 1)
+
+def init_accounts(app):
+    if app.config.get('SESSION_USER_CACHE_TTL', 30):
+        app.extensions['session_user_cache'] = LRUCache(maxsize=app.config.get('SESSION_USER_CACHE_SIZE', 10000),
+                                                        ttl=app.config.get('SESSION_USER_CACHE_TTL', 30))
+    hasher = PasswordHasher(workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+                            queue_size=app.config.get('PASSWORD_HASH_QUEUE_SIZE', 16),
+                            timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10))
+    app.extensions['password_hasher'] = hasher
+    atexit.register(hasher.shutdown)
+    app.extensions['login_rate_limiters'] = {
+        'ip': RateLimiter(app.config.get('LOGIN_RATE_LIMIT_IP_BURST', 20),
+                          app.config.get('LOGIN_RATE_LIMIT_IP_PER_MINUTE', 20) / 60),
+        'account': RateLimiter(app.config.get('LOGIN_RATE_LIMIT_ACCOUNT_BURST', 5),
+                               app.config.get('LOGIN_RATE_LIMIT_ACCOUNT_PER_MINUTE', 5) / 60)
+    }
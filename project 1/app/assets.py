@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+logger = logging.getLogger(__name__)
+
+# Stylesheets and scripts are built into static/dist/ under names that
+# include a hash of their content, so they can be cached forever: a changed
+# file gets a new name. Each one also gets .gz and, when the brotli package
+# is installed, .br copies so nothing is compressed per request.
+
+ASSET_DIRS = ('css', 'js')
+ASSET_EXTENSIONS = ('.css', '.js')
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def dist_folder():
+    return os.path.join(current_app.static_folder, DIST_DIR)
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    # Spaces before ':' are left alone, since they matter in selectors like "a :hover"
+    text = re.sub(r'\s*([{};,])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip()
+
+def minify_js(text):
+    """Minifies with rjsmin when it is installed. Otherwise scripts are only compressed."""
+    try:
+        import rjsmin
+    except ImportError:
+        return text
+    return rjsmin.jsmin(text)
+
+def compress(path, data):
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(data, quality=11))
+
+def build_assets():
+    """
+    Minifies every stylesheet and script under static/css and static/js,
+    writes it to static/dist/ under a content-hashed name with compressed
+    copies, and records the names in a manifest. Earlier builds are left in
+    place so pages rendered before a deploy keep working. Returns the manifest.
+    """
+    static = current_app.static_folder
+    dist = dist_folder()
+    manifest = {}
+    for top in ASSET_DIRS:
+        for folder, _, files in os.walk(os.path.join(static, top)):
+            for name in sorted(files):
+                stem, extension = os.path.splitext(name)
+                if extension not in ASSET_EXTENSIONS:
+                    continue
+                source = os.path.join(folder, name)
+                with open(source, encoding='utf-8') as f:
+                    text = f.read()
+                data = (minify_css(text) if extension == '.css' else minify_js(text)).encode('utf-8')
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                logical = os.path.relpath(source, static).replace(os.sep, '/')
+                built = f'{os.path.dirname(logical)}/{stem}.{digest}{extension}'
+                target = os.path.join(dist, built)
+                if not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with open(target, 'wb') as f:
+                        f.write(data)
+                    compress(target, data)
+                manifest[logical] = built
+    os.makedirs(dist, exist_ok=True)
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    current_app.extensions['asset_manifest'] = manifest
+    return manifest
+
+def load_manifest(app):
+    try:
+        with open(os.path.join(app.static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.error(f"Ignoring unreadable asset manifest: {e}")
+        return {}
+
+def asset_url(filename):
+    """URL of the built copy of a static asset, or of the file itself when no build includes it."""
+    built = current_app.extensions.get('asset_manifest', {}).get(filename)
+    if built is None:
+        return url_for('static', filename=filename)
+    return url_for('main.asset', filename=built)
+
+def send_asset(filename, max_age):
+    """Serves a built asset, picking the best precompressed copy the client accepts."""
+    folder = dist_folder()
+    mimetype = mimetypes.guess_type(filename)[0]
+    suffix = encoding = ''
+    for name, extension in ENCODINGS:
+        if request.accept_encodings[name]:
+            path = safe_join(folder, filename + extension)
+            if path is not None and os.path.isfile(path):
+                encoding, suffix = name, extension
+                break
+    response = send_from_directory(folder, filename + suffix, mimetype=mimetype, max_age=max_age)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f'public, max-age={max_age}, immutable'
+    return response
+
+def init_assets(app):
+    app.extensions['asset_manifest'] = load_manifest(app)
+    app.jinja_env.globals['asset_url'] = asset_url
@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
 from app.models import User
+from app.accounts import DISABLED_ROLE, LoginThrottled, check_password, hash_password, throttle_login
 from app import db
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField
@@ -43,7 +43,11 @@ def register():
             flash('Invalid password for Manager role.', 'danger')
             return render_template('register.html', form=form)
 
-        hashed_password = generate_password_hash(form.password.data, method='pbkdf2:sha256')
+        try:
+            hashed_password = hash_password(form.password.data)
+        except LoginThrottled as e:
+            flash(str(e), 'danger')
+            return render_template('register.html', form=form), 429, {'Retry-After': str(e.retry_after)}
         user = User(username=form.username.data, email=form.email.data, password=hashed_password, role=form.role.data)
         db.session.add(user)
         db.session.commit()
@@ -55,10 +59,15 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        if user and check_password_hash(user.password, form.password.data):
-            login_user(user)
-            return redirect(url_for('main.dashboard'))
+        try:
+            throttle_login(request.remote_addr, form.email.data)
+            user = User.query.filter_by(email=form.email.data).first()
+            if user and check_password(user.password, form.password.data) and user.role != DISABLED_ROLE:
+                login_user(user)
+                return redirect(url_for('main.dashboard'))
+        except LoginThrottled as e:
+            flash(str(e), 'danger')
+            return render_template('login.html', form=form), 429, {'Retry-After': str(e.retry_after)}
         flash('Invalid email or password', 'danger')
     return render_template('login.html', form=form)
 
@@ -0,0 +1,56 @@
+from flask import current_app
+from app.cache import LRUCache
+from app.models import Message, Notification
+
+BADGE_KINDS = ('notifications', 'messages')
+
+def init_badges(app, backend=None):
+    """
+    Sets up the per-user unread counter cache. Pass any CacheBackend to
+    share counts between processes; the default lives in this process only.
+    """
+    if backend is None:
+        backend = LRUCache(maxsize=app.config.get('UNREAD_CACHE_SIZE', 10000),
+                           ttl=app.config.get('UNREAD_CACHE_TTL', 60))
+    app.extensions['unread_cache'] = backend
+
+    @app.context_processor
+    def inject_unread_counts():
+        from flask_login import current_user
+        if current_user.is_authenticated:
+            return {'unread_counts': unread_counts(current_user.id)}
+        return {'unread_counts': None}
+
+def cache_key(kind, user_id):
+    return f'unread:{kind}:{user_id}'
+
+def count_unread(kind, user_id):
+    if kind == 'notifications':
+        return Notification.query.filter_by(user_id=user_id, read=False).count()
+    return Message.query.filter_by(recipient_id=user_id, read=False).count()
+
+def unread_counts(user_id):
+    cache = current_app.extensions['unread_cache']
+    counts = {}
+    for kind in BADGE_KINDS:
+        key = cache_key(kind, user_id)
+        count = cache.get(key)
+        if count is None:
+            count = count_unread(kind, user_id)
+            cache.set(key, count)
+        counts[kind] = count
+    return counts
+
+def bump_unread(kind, user_ids, delta=1):
+    """Adjusts cached counts for users who have one; everyone else is recounted on their next page view."""
+    cache = current_app.extensions['unread_cache']
+    if isinstance(user_ids, int):
+        user_ids = [user_ids]
+    for user_id in user_ids:
+        cache.incr(cache_key(kind, user_id), delta)
+
+def reset_unread(kind, user_id):
+    current_app.extensions['unread_cache'].set(cache_key(kind, user_id), 0)
+
+def invalidate_unread(kind, user_id):
+    current_app.extensions['unread_cache'].delete(cache_key(kind, user_id))
@@ -0,0 +1,190 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+class CacheBackend(ABC):
+    """
+    Interface for the app's key/value caches. Backends may drop entries at
+    any time; callers treat a None from get() as a miss and recompute.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def incr(self, key, delta=1):
+        """Adds delta to a cached number. Missing keys stay missing."""
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+class LRUCache(CacheBackend):
+    """
+    Thread-safe in-process cache with least-recently-used eviction and
+    per-entry expiry. Bounded by entry count, and optionally by total
+    size as measured by size_of(value).
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, max_bytes=None, size_of=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size_of = size_of or (lambda value: 0)
+        self.bytes = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _pop(self, key):
+        value, expires, size = self.data.pop(key)
+        self.bytes -= size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            value, expires, size = entry
+            if expires is not None and expires < time.monotonic():
+                self._pop(key)
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        size = self.size_of(value)
+        with self.lock:
+            if key in self.data:
+                self._pop(key)
+            self.data[key] = (value, expires, size)
+            self.bytes += size
+            while len(self.data) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._pop(next(iter(self.data)))
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.data:
+                self._pop(key)
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                self.data[key] = (entry[0] + delta, entry[1], entry[2])
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+class DiskCache(CacheBackend):
+    """
+    Pickle-per-entry cache in a directory, shared by every process that
+    points at it. Writes go through a temp file and os.replace so readers
+    never see partial entries. With max_bytes, every prune_every writes
+    deletes the least recently used entries (by mtime, which hits refresh)
+    until the directory is back under nine tenths of that size.
+    """
+
+    def __init__(self, directory, ttl=300, max_bytes=None, prune_every=100):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prune_every = prune_every
+        self.writes = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                value, expires = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        if self.max_bytes is not None:
+            try:
+                os.utime(self.path(key))
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        temp = os.path.join(self.directory, f'.{uuid.uuid4().hex}')
+        with open(temp, 'wb') as f:
+            pickle.dump((value, expires), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path(key))
+        if self.max_bytes is not None:
+            with self.lock:
+                self.writes += 1
+                due = self.writes % self.prune_every == 0
+            if due:
+                self.prune()
+
+    def prune(self):
+        """Deletes the least recently used entries until the cache fits in 90% of max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                # Skips subdirectories and temp files still being written
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def incr(self, key, delta=1):
+        value = self.get(key)
+        if value is not None:
+            self.set(key, value + delta)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
@@ -0,0 +1,132 @@
+import click
+from app import db
+
+def register_commands(app):
+    @app.cli.command('reconcile-counters')
+    def reconcile_counters_command():
+        """Remove duplicate likes and follows and rebuild the denormalized counters."""
+        from app.counters import remove_duplicate_friendships, remove_duplicate_likes, reconcile_counters
+        from app.schema import upgrade_schema
+        removed_likes = remove_duplicate_likes()
+        removed_follows = remove_duplicate_friendships()
+        reconcile_counters()
+        db.session.commit()
+        upgrade_schema()
+        click.echo(f"Removed {removed_likes} duplicate likes and {removed_follows} duplicate follows and rebuilt counters.")
+
+    @app.cli.command('migrate')
+    @click.option('--status', is_flag=True, help='Show the schema version without applying anything.')
+    def migrate_command(status):
+        """Apply pending database schema migrations."""
+        from app.migrations import current_version, latest_version, migrate
+        if status:
+            click.echo(f"Schema version {current_version()} of {latest_version()}.")
+            return
+        applied = migrate()
+        click.echo(f"Applied {len(applied)} migrations" + (f": {', '.join(applied)}." if applied else "."))
+
+    @app.cli.command('backfill-excerpts')
+    @click.option('--batch-size', default=1000, show_default=True)
+    def backfill_excerpts_command(batch_size):
+        """Fill in stored excerpts and rendered bodies for posts that lack them."""
+        from app.migrations import backfill_post_text
+        updated = backfill_post_text(batch_size=batch_size)
+        click.echo(f"Filled in excerpts for {updated} posts.")
+
+    @app.cli.command('startup-report')
+    def startup_report_command():
+        """Show how long creating the app took, phase by phase, and time a template warmup."""
+        import time
+        from app.startup import warm_templates
+        timer = app.extensions['startup_timer']
+        for phase, seconds in timer.phases:
+            click.echo(f"{phase:<12} {seconds * 1000:8.1f} ms")
+        click.echo(f"{'total':<12} {timer.total() * 1000:8.1f} ms")
+        started = time.perf_counter()
+        count = warm_templates(app)
+        click.echo(f"Loading {count} templates takes {(time.perf_counter() - started) * 1000:.1f} ms "
+                   f"({'bytecode cache' if app.jinja_env.bytecode_cache else 'no bytecode cache'}).")
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Minify, fingerprint and precompress the stylesheets and scripts."""
+        from app.assets import build_assets
+        manifest = build_assets()
+        click.echo(f"Built {len(manifest)} assets into app/static/dist/.")
+
+    @app.cli.command('purge-user')
+    @click.argument('user_id', type=int)
+    @click.option('--batch-size', default=500, show_default=True)
+    def purge_user_command(user_id, batch_size):
+        """Delete a user and everything they made, or finish a purge that was interrupted."""
+        from app.purge import purge_user
+        posts = purge_user(user_id, chunk_size=batch_size)
+        if posts is None:
+            raise click.ClickException(f"There is no user {user_id}.")
+        click.echo(f"Deleted user {user_id} and {posts} posts.")
+
+    @app.cli.command('requeue-media')
+    @click.option('--minutes', default=30, show_default=True, help='Only posts processing for longer than this.')
+    def requeue_media_command(minutes):
+        """Process again the media of posts stuck processing, e.g. after a worker restart."""
+        from app.media import requeue_stuck_media
+        requeued, failed = requeue_stuck_media(minutes=minutes)
+        click.echo(f"Processed {requeued} stuck posts and failed {failed} whose uploads were missing.")
+
+    @app.cli.command('sweep-uploads')
+    def sweep_uploads_command():
+        """Delete uploads that no post or user references any more, and files the store has no record of."""
+        from app.storage import sweep_orphaned_files, sweep_unreferenced_files
+        removed = sweep_unreferenced_files()
+        orphaned = sweep_orphaned_files()
+        click.echo(f"Removed {removed} unreferenced uploads and {orphaned} orphaned files.")
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Rebuild the full-text search index from the post and user tables."""
+        from app.search import init_search_index, rebuild_search_index
+        if not init_search_index():
+            raise click.ClickException("This database does not support FTS5 full-text search.")
+        rebuild_search_index()
+        click.echo("Search index rebuilt.")
+
+    @app.cli.command('compact-notifications')
+    @click.option('--days', default=90, show_default=True, help='Keep read notifications newer than this.')
+    @click.option('--batch-size', default=1000, show_default=True)
+    def compact_notifications_command(days, batch_size):
+        """Delete old read notifications in batches."""
+        from app.retention import compact_notifications
+        removed = compact_notifications(older_than_days=days, batch_size=batch_size)
+        click.echo(f"Removed {removed} read notifications older than {days} days.")
+
+    @app.cli.command('migrate-uploads')
+    def migrate_uploads_command():
+        """Move flat legacy uploads into the content-addressed upload store."""
+        from app.storage import migrate_legacy_uploads
+        migrated = migrate_legacy_uploads()
+        click.echo(f"Migrated {migrated} uploads.")
+
+    @app.cli.command('recompute-suggestions')
+    @click.option('--batch-size', default=500, show_default=True)
+    def recompute_suggestions_command(batch_size):
+        """Recompute people-you-may-know suggestions for every user."""
+        from app.suggestions import recompute_suggestions
+        if app.config.get('SUGGESTIONS_CACHE_BACKEND') != 'disk':
+            raise click.ClickException("Set SUGGESTIONS_CACHE_BACKEND=disk so the web workers can read the results.")
+        processed = recompute_suggestions(batch_size=batch_size)
+        click.echo(f"Recomputed suggestions for {processed} users.")
+
+    @app.cli.command('rebuild-timelines')
+    def rebuild_timelines_command():
+        """Backfill home timelines from every existing follow."""
+        from app.timeline import rebuild_timelines
+        processed = rebuild_timelines()
+        click.echo(f"Backfilled timelines for {processed} follows.")
+
+    @app.cli.command('trim-timelines')
+    @click.option('--keep', default=1000, show_default=True, help='Entries to keep per timeline.')
+    def trim_timelines_command(keep):
+        """Delete all but the newest entries of every home timeline."""
+        from app.timeline import trim_timelines
+        removed = trim_timelines(keep=keep)
+        click.echo(f"Removed {removed} timeline entries.")
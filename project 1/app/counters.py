@@ -0,0 +1,54 @@
+from sqlalchemy import and_, func, select, update
+from app import db
+from app.page_cache import invalidate, invalidate_all
+from app.models import Post, Comment, Like, User, Friendship
+
+def increment(model, row_id, **deltas):
+    """
+    Adds deltas to counter columns with a single UPDATE ... SET x = x + n,
+    inside the caller's transaction, e.g. increment(Post, 1, like_count=1).
+    """
+    values = {getattr(model, name): getattr(model, name) + delta for name, delta in deltas.items()}
+    db.session.execute(update(model).where(model.id == row_id).values(values)
+                       .execution_options(synchronize_session=False))
+    invalidate(f'{model.__tablename__}:{row_id}')
+
+def like_count_column(is_like):
+    return 'like_count' if is_like else 'dislike_count'
+
+def remove_duplicate_likes():
+    """Keeps the oldest Like per (user, post) and (user, comment) pair."""
+    deleted = 0
+    for target in (Like.post_id, Like.comment_id):
+        keep = select(func.min(Like.id)).where(target.isnot(None)).group_by(Like.user_id, target)
+        result = db.session.execute(
+            Like.__table__.delete().where(and_(target.isnot(None), Like.id.not_in(keep)))
+        )
+        deleted += result.rowcount
+    return deleted
+
+def remove_duplicate_friendships():
+    """Keeps the oldest Friendship per (follower, followed) pair."""
+    keep = select(func.min(Friendship.id)).group_by(Friendship.follower_id, Friendship.followed_id)
+    result = db.session.execute(Friendship.__table__.delete().where(Friendship.id.not_in(keep)))
+    return result.rowcount
+
+def reconcile_counters():
+    """Rebuilds the denormalized like/dislike/comment and follower counters from the source rows."""
+    def count_likes(target, row_id, is_like):
+        return select(func.count(Like.id)).where(target == row_id, Like.is_like == is_like).scalar_subquery()
+
+    db.session.execute(update(Post).values(
+        like_count=count_likes(Like.post_id, Post.id, True),
+        dislike_count=count_likes(Like.post_id, Post.id, False),
+        comment_count=select(func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+    ).execution_options(synchronize_session=False))
+    db.session.execute(update(Comment).values(
+        like_count=count_likes(Like.comment_id, Comment.id, True),
+        dislike_count=count_likes(Like.comment_id, Comment.id, False)
+    ).execution_options(synchronize_session=False))
+    db.session.execute(update(User).values(
+        followers_count=select(func.count(Friendship.id)).where(Friendship.followed_id == User.id).scalar_subquery(),
+        following_count=select(func.count(Friendship.id)).where(Friendship.follower_id == User.id).scalar_subquery()
+    ).execution_options(synchronize_session=False))
+    invalidate_all()
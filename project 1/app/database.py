@@ -0,0 +1,39 @@
+import os
+from sqlalchemy import event
+from app import db
+
+# Applied to every new SQLite connection in production
+PRODUCTION_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms to wait on a locked database before failing
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # negative means KiB, so ~64 MB per connection
+}
+
+PRODUCTION_ENGINE_OPTIONS = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_timeout': 30,
+    'pool_recycle': 3600,
+    'pool_pre_ping': True,
+}
+
+def configure_engine(app):
+    """
+    Sets per-connection SQLite PRAGMAs and makes the connection pool safe
+    to use from forked worker processes. Must run inside an app context.
+    """
+    engine = db.engine
+    pragmas = app.config.get('SQLITE_PRAGMAS') or {}
+    if engine.dialect.name == 'sqlite' and pragmas:
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+            cursor.close()
+
+    if app.config.get('APP_CONFIG') == 'production' and hasattr(os, 'register_at_fork'):
+        # Children of a preloading master (gunicorn --preload) must not reuse the parent's sockets/files
+        os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
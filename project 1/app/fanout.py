@@ -0,0 +1,140 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from flask import current_app
+from sqlalchemy import insert
+from app import db
+from app.sanitize import clean
+from app.badges import bump_unread
+from app.models import Friendship, Notification
+
+logger = logging.getLogger(__name__)
+
+FANOUT_CHUNK_SIZE = 5000
+
+def fan_out_to_followers(user_id, content):
+    """
+    Inserts one notification for every follower of user_id using bulk
+    inserts inside a single transaction. Returns the number of rows written.
+    """
+    content = clean(content)
+    follower_ids = db.session.query(Friendship.follower_id).filter_by(followed_id=user_id)
+    notified = []
+    chunk = []
+    for (follower_id,) in follower_ids.yield_per(FANOUT_CHUNK_SIZE):
+        chunk.append({'user_id': follower_id, 'content': content})
+        if len(chunk) >= FANOUT_CHUNK_SIZE:
+            db.session.execute(insert(Notification), chunk)
+            notified.extend(row['user_id'] for row in chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert(Notification), chunk)
+        notified.extend(row['user_id'] for row in chunk)
+    db.session.commit()
+    bump_unread('notifications', notified)
+    return len(notified)
+
+class FanoutWorker:
+    """
+    In-process thread pool that runs follower fan-outs off the request thread.
+    Jobs wait in a bounded queue; submit() returns False when it is full so
+    the caller can fall back to running the fan-out inline.
+    """
+
+    def __init__(self, app, workers=2, queue_size=1000):
+        self.app = app
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.notifications = 0
+        self.seconds = 0.0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f'fanout-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, user_id, content):
+        try:
+            self.queue.put_nowait((user_id, content))
+            return True
+        except queue.Full:
+            logger.warning("Notification fan-out queue is full, running fan-out inline")
+            return False
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.run_job(*job)
+            except Exception as e:
+                logger.error(f"Notification fan-out failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def run_job(self, user_id, content):
+        start = time.perf_counter()
+        with self.app.app_context():
+            count = fan_out_to_followers(user_id, content)
+        self.record(count, time.perf_counter() - start)
+
+    def record(self, count, seconds):
+        with self.lock:
+            self.jobs += 1
+            self.notifications += count
+            self.seconds += seconds
+        rate = count / seconds if seconds else 0
+        logger.info(f"Fanned out {count} notifications in {seconds:.3f}s ({rate:.0f}/s), queue depth {self.queue.qsize()}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'jobs': self.jobs,
+                'notifications': self.notifications,
+                'seconds': self.seconds,
+                'throughput': self.notifications / self.seconds if self.seconds else 0.0,
+                'queue_depth': self.queue.qsize()
+            }
+
+    def shutdown(self):
+        """Waits for queued fan-outs to finish, then stops the worker threads."""
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+def init_fanout(app):
+    if not app.config.get('NOTIFICATION_FANOUT_ASYNC'):
+        return
+    worker = FanoutWorker(app,
+                          workers=app.config.get('NOTIFICATION_FANOUT_WORKERS', 2),
+                          queue_size=app.config.get('NOTIFICATION_FANOUT_QUEUE_SIZE', 1000))
+    app.extensions['notification_fanout'] = worker
+    atexit.register(worker.shutdown)
+
+def notify_followers(user_id, content):
+    """
+    Notifies every follower of user_id, in the background when the
+    fan-out worker is enabled and inline otherwise.
+    """
+    worker = current_app.extensions.get('notification_fanout')
+    if worker and worker.submit(user_id, content):
+        return
+    start = time.perf_counter()
+    count = fan_out_to_followers(user_id, content)
+    seconds = time.perf_counter() - start
+    if worker:
+        worker.record(count, seconds)
+    else:
+        logger.info(f"Fanned out {count} notifications in {seconds:.3f}s")
+
+def announce_post(post):
+    from app.timeline import fan_out_post
+    fan_out_post(post)
+    notify_followers(post.user_id, f"{post.author.username} posted a new blog: {post.title}")
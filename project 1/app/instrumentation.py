@@ -0,0 +1,203 @@
+import cProfile
+import hmac
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import Response, abort, current_app, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from app import db
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Long-poll requests are slow by design, so they stay out of the slow-request
+# log and the duration histogram
+UNTIMED_ENDPOINTS = {'main.conversation_updates'}
+
+class Metrics:
+    """
+    Per-endpoint request, SQL and N+1 counters for this process, rendered
+    in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.seconds = defaultdict(float)
+        self.timed = Counter()
+        self.buckets = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+        self.queries = Counter()
+        self.query_seconds = defaultdict(float)
+        self.n_plus_one = Counter()
+        self.slow = Counter()
+
+    def record(self, endpoint, status, seconds, queries, query_seconds, n_plus_one, slow):
+        """seconds is None for requests left out of the duration histogram."""
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+            if seconds is not None:
+                self.timed[endpoint] += 1
+                self.seconds[endpoint] += seconds
+                buckets = self.buckets[endpoint]
+                for i, bound in enumerate(DURATION_BUCKETS):
+                    if seconds <= bound:
+                        buckets[i] += 1
+            self.queries[endpoint] += queries
+            self.query_seconds[endpoint] += query_seconds
+            if n_plus_one:
+                self.n_plus_one[endpoint] += 1
+            if slow:
+                self.slow[endpoint] += 1
+
+    def render(self, extra=None):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        with self.lock:
+            metric('http_requests_total', 'counter', 'Requests handled, by endpoint and status.',
+                   [((('endpoint', endpoint), ('status', status)), count)
+                    for (endpoint, status), count in sorted(self.requests.items())])
+            lines.append('# HELP http_request_duration_seconds Request wall time.')
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for endpoint, buckets in sorted(self.buckets.items()):
+                for bound, count in zip(DURATION_BUCKETS, buckets):
+                    lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {self.timed[endpoint]}')
+                lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.seconds[endpoint]}')
+                lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {self.timed[endpoint]}')
+            metric('sql_queries_total', 'counter', 'SQL statements executed while handling requests.',
+                   [((('endpoint', endpoint),), count) for endpoint, count in sorted(self.queries.items())])
+            metric('sql_query_seconds_total', 'counter', 'Time spent executing SQL while handling requests.',
+                   [((('endpoint', endpoint),), seconds) for endpoint, seconds in sorted(self.query_seconds.items())])
+            metric('sql_n_plus_one_requests_total', 'counter', 'Requests that repeated one statement past the N+1 threshold.',
+                   [((('endpoint', endpoint),), count) for endpoint, count in sorted(self.n_plus_one.items())])
+            metric('http_slow_requests_total', 'counter', 'Requests slower than the slow-request threshold.',
+                   [((('endpoint', endpoint),), count) for endpoint, count in sorted(self.slow.items())])
+        for name, (kind, help_text, value) in sorted((extra or {}).items()):
+            metric(name, kind, help_text, [((), value)])
+        return '\n'.join(lines) + '\n'
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_statements' in g:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_statements' in g:
+        started = conn.info['query_start'].pop()
+        g.sql_time += time.perf_counter() - started
+        g.sql_statements[statement] += 1
+
+def fanout_metrics():
+    worker = current_app.extensions.get('notification_fanout')
+    if worker is None:
+        return {}
+    stats = worker.stats()
+    return {
+        'notification_fanout_jobs_total': ('counter', 'Follower fan-out jobs completed.', stats['jobs']),
+        'notification_fanout_notifications_total': ('counter', 'Notifications written by fan-out.', stats['notifications']),
+        'notification_fanout_queue_depth': ('gauge', 'Fan-out jobs waiting to run.', stats['queue_depth'])
+    }
+
+class Instrumentation:
+    """
+    Times every request and the SQL it runs, logs slow requests and
+    repeated statements, and profiles a sample of requests with cProfile.
+    """
+
+    def __init__(self, app):
+        self.metrics = Metrics()
+        self.slow_seconds = app.config.get('INSTRUMENTATION_SLOW_REQUEST_SECONDS', 1.0)
+        self.n_plus_one_threshold = app.config.get('INSTRUMENTATION_N_PLUS_ONE_THRESHOLD', 10)
+        self.profile_rate = app.config.get('INSTRUMENTATION_PROFILE_SAMPLE_RATE', 0.0)
+        self.profile_dir = app.config.get('INSTRUMENTATION_PROFILE_DIR')
+        self.metrics_token = app.config.get('METRICS_TOKEN')
+        # cProfile can only run one profiler per process at a time
+        self.profile_lock = threading.Lock()
+
+    def start_request(self):
+        g.request_start = time.perf_counter()
+        g.sql_time = 0.0
+        g.sql_statements = Counter()
+        if self.profile_rate and random.random() < self.profile_rate and self.profile_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            try:
+                g.profiler.enable()
+            except ValueError:
+                # Another profiler, such as a debugger, is already active
+                del g.profiler
+                self.profile_lock.release()
+
+    def finish_request(self, response):
+        if 'request_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'unknown'
+        queries = sum(g.sql_statements.values())
+        repeated = False
+        if g.sql_statements:
+            statement, count = g.sql_statements.most_common(1)[0]
+            if count > self.n_plus_one_threshold:
+                repeated = True
+                logger.warning(f"Possible N+1 in {endpoint}: statement ran {count} times: {' '.join(statement.split())[:300]}")
+        timed = endpoint not in UNTIMED_ENDPOINTS
+        slow = timed and seconds >= self.slow_seconds
+        if slow:
+            logger.warning(f"Slow request {request.method} {request.full_path} -> {response.status_code} "
+                           f"in {seconds:.3f}s ({queries} queries, {g.sql_time:.3f}s in SQL)")
+        self.metrics.record(endpoint, response.status_code, seconds if timed else None, queries, g.sql_time, repeated, slow)
+        response.headers['Server-Timing'] = f'app;dur={seconds * 1000:.1f}, db;dur={g.sql_time * 1000:.1f}'
+        if 'profiler' in g:
+            self.save_profile(endpoint)
+        return response
+
+    def save_profile(self, endpoint):
+        profiler = g.pop('profiler')
+        try:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{os.getpid()}.prof')
+            profiler.dump_stats(path)
+            logger.info(f"Saved profile of {request.method} {request.path} to {path}")
+        finally:
+            self.profile_lock.release()
+
+    def teardown(self, exc):
+        # Requests that raised skip after_request, so the profiler is released here
+        if 'profiler' in g:
+            g.pop('profiler').disable()
+            self.profile_lock.release()
+
+    def can_read_metrics(self):
+        """A scraper sends the METRICS_TOKEN as a bearer token; people sign in as a Manager or Admin."""
+        auth = request.headers.get('Authorization', '')
+        if self.metrics_token and auth.startswith('Bearer '):
+            return hmac.compare_digest(auth[len('Bearer '):].encode(), self.metrics_token.encode())
+        return current_user.is_authenticated and current_user.role in ['Manager', 'Admin']
+
+    def metrics_view(self):
+        if not self.can_read_metrics():
+            abort(404)
+        return Response(self.metrics.render(fanout_metrics()), mimetype='text/plain; version=0.0.4')
+
+def init_instrumentation(app):
+    if not app.config.get('INSTRUMENTATION_ENABLED'):
+        return
+    instrumentation = Instrumentation(app)
+    app.extensions['instrumentation'] = instrumentation
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(instrumentation.start_request)
+    app.after_request(instrumentation.finish_request)
+    app.teardown_request(instrumentation.teardown)
+    app.add_url_rule('/metrics', 'metrics', instrumentation.metrics_view)
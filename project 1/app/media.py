@@ -0,0 +1,245 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from app import db
+
+logger = logging.getLogger(__name__)
+
+MAX_VIDEO_DURATION = 1200  # 20 minutes
+IMAGE_MAX_WIDTH = 1280
+VIDEO_MAX_WIDTH = 1280
+VIDEO_BITRATE = '1500k'
+AUDIO_BITRATE = '128k'
+STUCK_AFTER_MINUTES = 30
+
+class MediaRejected(Exception):
+    pass
+
+# The functions below run in worker processes, so they only take and return plain values
+
+def variant_path(folder, extension):
+    """
+    A new, uniquely named file in the upload folder's temp directory. Two
+    posts with the same upload may be processed at once, so variants never
+    get a name derived from the original; store_local_file() names them.
+    """
+    temp = os.path.join(folder, '.tmp')
+    os.makedirs(temp, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=f'.{extension}', dir=temp)
+    os.close(fd)
+    return path
+
+def discard_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def process_image(folder, filename):
+    """
+    Writes a resized JPEG and a WebP variant to temporary files. Returns
+    {'image': ..., 'image_webp': ...} with their paths.
+    """
+    from PIL import Image, ImageOps
+    variants = {'image': variant_path(folder, 'jpg'), 'image_webp': variant_path(folder, 'webp')}
+    try:
+        with Image.open(os.path.join(folder, filename)) as image:
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            image.thumbnail((IMAGE_MAX_WIDTH, IMAGE_MAX_WIDTH * 4))
+            image.save(variants['image'], 'JPEG', quality=82, optimize=True, progressive=True)
+            image.save(variants['image_webp'], 'WEBP', quality=80, method=4)
+    except Exception:
+        discard_files(variants.values())
+        raise
+    return variants
+
+def process_video(folder, filename):
+    """
+    Probes the upload, transcodes it to a web-friendly H.264/AAC MP4 and
+    grabs a poster frame into temporary files. Returns {'video': ..., 'poster': ...}
+    with their paths.
+    """
+    import ffmpeg
+    source = os.path.join(folder, filename)
+    try:
+        probe = ffmpeg.probe(source)
+        duration = float(probe['format']['duration'])
+    except Exception:
+        raise MediaRejected('Video could not be read.')
+    if duration > MAX_VIDEO_DURATION:
+        raise MediaRejected('Video must be 20 minutes or less.')
+
+    variants = {'video': variant_path(folder, 'mp4'), 'poster': variant_path(folder, 'jpg')}
+    try:
+        (ffmpeg.input(source)
+            .output(variants['video'], vcodec='libx264', preset='veryfast',
+                    video_bitrate=VIDEO_BITRATE, maxrate=VIDEO_BITRATE, bufsize='3000k',
+                    vf=f"scale='min({VIDEO_MAX_WIDTH},iw)':-2", acodec='aac', audio_bitrate=AUDIO_BITRATE,
+                    movflags='+faststart')
+            .overwrite_output()
+            .run(quiet=True))
+        (ffmpeg.input(source, ss=min(1.0, duration / 2))
+            .output(variants['poster'], vframes=1)
+            .overwrite_output()
+            .run(quiet=True))
+    except Exception:
+        discard_files(variants.values())
+        raise
+    return variants
+
+def process_post_media(folder, image, video):
+    """Returns (updates, error) where updates maps Post columns to the paths of new variants."""
+    updates = {}
+    if image:
+        try:
+            updates.update(process_image(folder, image))
+        except Exception as e:
+            # Serving the original image is an acceptable fallback
+            logger.warning(f"Could not create image variants for {image}: {e}")
+    if video:
+        try:
+            updates.update(process_video(folder, video))
+        except MediaRejected as e:
+            return updates, str(e)
+        except Exception as e:
+            return updates, f'Video processing failed: {e}'
+    return updates, None
+
+class MediaPipeline:
+    """
+    Runs post media processing in a pool of worker processes. The pool is
+    created on first use with the spawn start method, so it is never
+    inherited by forked WSGI workers.
+    """
+
+    def __init__(self, app, workers=2):
+        self.app = app
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, post_id, image, video):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        future = self.executor.submit(process_post_media, self.app.config['UPLOAD_FOLDER'], image, video)
+        future.add_done_callback(lambda done: self.finish(post_id, image, video, done))
+
+    def finish(self, post_id, image, video, future):
+        with self.app.app_context():
+            try:
+                updates, error = future.result()
+            except Exception as e:
+                updates, error = {}, f'Media processing failed: {e}'
+            finish_post_media(post_id, image, video, updates, error)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+def finish_post_media(post_id, image, video, updates, error):
+    """
+    Stores the processed variants and publishes the post, or marks it
+    failed. Runs in a future's done callback, where an exception would only
+    be logged by the executor, so any error fails the post instead of
+    leaving it processing.
+    """
+    from app.models import Post
+    from app.fanout import announce_post
+    from app.storage import store_local_file, release_many, request_sweep
+    try:
+        post = db.session.get(Post, post_id)
+        # Gone, or already finished by an earlier run of the same job
+        if post is None or post.status != 'processing' or (post.image, post.video) != (image, video):
+            return
+        for column, path in updates.items():
+            setattr(post, column, store_local_file(path))
+        # The processed variants replace the originals, so the store can drop them
+        release_many(original for column, original in (('image', image), ('video', video)) if column in updates)
+        post.status = 'failed' if error else 'ready'
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Finishing media for post {post_id} failed: {e}")
+        fail_post(post_id, f'Media processing failed: {e}')
+        return
+    finally:
+        # Variants that weren't moved into the store
+        discard_files(path for path in updates.values() if os.path.exists(path))
+    if updates:
+        request_sweep()
+
+    try:
+        if error:
+            notify_failure(post, error)
+        else:
+            announce_post(post)
+    except Exception as e:
+        # The post is already published or failed; only the notifications are lost
+        db.session.rollback()
+        logger.error(f"Notifying followers of post {post_id} failed: {e}")
+
+def notify_failure(post, error):
+    from app.routes import create_notification
+    create_notification(post.user_id, f"Your post \"{post.title}\" could not be published: {error}")
+
+def fail_post(post_id, error):
+    """Marks a post whose media could not be finished as failed and tells its author."""
+    from app.models import Post
+    try:
+        post = db.session.get(Post, post_id)
+        if post is None or post.status != 'processing':
+            return
+        post.status = 'failed'
+        db.session.commit()
+        notify_failure(post, error)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Could not mark post {post_id} as failed: {e}")
+
+def requeue_stuck_media(minutes=STUCK_AFTER_MINUTES):
+    """
+    Processes again, inline, the media of posts that have been processing
+    for more than minutes, such as posts whose job was lost when a worker
+    restarted. Posts whose uploads are gone are failed. Returns
+    (requeued, failed).
+    """
+    from app.models import Post
+    from app.storage import upload_folder
+    folder = upload_folder()
+    cutoff = datetime.utcnow() - timedelta(minutes=minutes)
+    stuck = db.session.query(Post.id, Post.image, Post.video) \
+        .filter(Post.status == 'processing', Post.date_posted < cutoff).all()
+    requeued = failed = 0
+    for post_id, image, video in stuck:
+        if any(filename and not os.path.exists(os.path.join(folder, filename)) for filename in (image, video)):
+            fail_post(post_id, 'The uploaded media was lost before it could be processed.')
+            failed += 1
+            continue
+        updates, error = process_post_media(folder, image, video)
+        finish_post_media(post_id, image, video, updates, error)
+        requeued += 1
+    return requeued, failed
+
+def init_media(app):
+    pipeline = MediaPipeline(app, workers=app.config.get('MEDIA_WORKERS', 2))
+    app.extensions['media_pipeline'] = pipeline
+    atexit.register(pipeline.shutdown)
+
+def submit_post_media(post, image, video):
+    """Processes the post's uploads in the background, or inline when MEDIA_PROCESSING_ASYNC is off."""
+    if current_app.config.get('MEDIA_PROCESSING_ASYNC', True):
+        current_app.extensions['media_pipeline'].submit(post.id, image, video)
+    else:
+        updates, error = process_post_media(current_app.config['UPLOAD_FOLDER'], image, video)
+        finish_post_media(post.id, image, video, updates, error)
@@ -0,0 +1,180 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import case, func, literal, select, union_all, update
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models import Message, User
+from app.pagination import keyset_page
+
+logger = logging.getLogger(__name__)
+
+# Users share signal files by id modulo this; a shared file only causes a spare re-read
+SIGNAL_BUCKETS = 256
+
+ConversationSummary = namedtuple('ConversationSummary', ['other_user', 'last_message', 'unread_count'])
+
+def conversation_summaries(user_id, page=1, per_page=30):
+    """
+    Returns (summaries, has_next) with one ConversationSummary per counterpart,
+    most recent conversation first. Each half of the union is served by one
+    of the (sender_id, recipient_id, date_sent) / (recipient_id, sender_id, date_sent) indexes.
+    """
+    sent = select(
+        Message.recipient_id.label('other_id'),
+        Message.id.label('message_id'),
+        literal(0).label('unread')
+    ).where(Message.sender_id == user_id)
+    received = select(
+        Message.sender_id.label('other_id'),
+        Message.id.label('message_id'),
+        case((Message.read == False, 1), else_=0).label('unread')
+    ).where(Message.recipient_id == user_id)
+    exchanged = union_all(sent, received).subquery()
+
+    grouped = select(
+        exchanged.c.other_id,
+        func.max(exchanged.c.message_id).label('last_id'),
+        func.sum(exchanged.c.unread).label('unread_count')
+    ).group_by(exchanged.c.other_id).subquery()
+
+    rows = db.session.execute(
+        select(User, Message, grouped.c.unread_count)
+        .join(grouped, User.id == grouped.c.other_id)
+        .join(Message, Message.id == grouped.c.last_id)
+        .order_by(grouped.c.last_id.desc())
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1)
+    ).all()
+    summaries = [ConversationSummary(other, message, unread or 0) for other, message, unread in rows[:per_page]]
+    return summaries, len(rows) > per_page
+
+def between(user_id, other_id):
+    return ((Message.sender_id == user_id) & (Message.recipient_id == other_id)) | \
+        ((Message.sender_id == other_id) & (Message.recipient_id == user_id))
+
+def conversation_page(user_id, other_id, cursor=None, per_page=50):
+    """
+    Returns (messages, older_cursor): the newest per_page messages of the
+    conversation before cursor, oldest first for display.
+    """
+    query = Message.query.options(joinedload(Message.sender)).filter(between(user_id, other_id))
+    messages, older_cursor = keyset_page(query, Message.date_sent, Message.id, cursor=cursor, per_page=per_page)
+    return messages[::-1], older_cursor
+
+def messages_since(user_id, other_id, since_id, limit=100):
+    return Message.query.options(joinedload(Message.sender)) \
+        .filter(between(user_id, other_id), Message.id > since_id) \
+        .order_by(Message.id).limit(limit).all()
+
+def mark_conversation_read(user_id, other_id):
+    """Marks every unread message from other_id to user_id read with one UPDATE. Returns the number marked."""
+    result = db.session.execute(update(Message)
+                                .where(Message.recipient_id == user_id, Message.sender_id == other_id,
+                                       Message.read == False)
+                                .values(read=True).execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount
+
+class MessageBroker:
+    """
+    Wake-up channel for long-polling clients. publish() bumps a per-user
+    version and wakes that user's waiters in this process, who then re-read
+    the database. With a signal_dir it also stamps a file for the user, which
+    waiters in other worker processes check every signal_interval seconds.
+    Each waiter holds a worker thread, so at most max_waiters wait at once.
+    """
+
+    def __init__(self, max_waiters=None, signal_dir=None, signal_interval=1.0):
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.conditions = {}
+        self.slots = threading.BoundedSemaphore(max_waiters) if max_waiters else None
+        self.signal_dir = signal_dir
+        self.signal_interval = signal_interval
+        if signal_dir:
+            os.makedirs(signal_dir, exist_ok=True)
+
+    def signal_path(self, user_id):
+        return os.path.join(self.signal_dir, str(user_id % SIGNAL_BUCKETS))
+
+    def signal_stamp(self, user_id):
+        if not self.signal_dir:
+            return None
+        try:
+            return os.stat(self.signal_path(user_id)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def version(self, user_id):
+        """An opaque token for wait(); read it before querying for messages."""
+        stamp = self.signal_stamp(user_id)
+        with self.lock:
+            return self.versions.get(user_id, 0), stamp
+
+    def publish(self, *user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.versions[user_id] = self.versions.get(user_id, 0) + 1
+                if user_id in self.conditions:
+                    self.conditions[user_id][0].notify_all()
+        if self.signal_dir:
+            for user_id in user_ids:
+                self.signal(user_id)
+
+    def signal(self, user_id):
+        path = self.signal_path(user_id)
+        try:
+            with open(path, 'a'):
+                pass
+            # An explicit stamp, so two signals within one filesystem clock tick still differ
+            now = time.time_ns()
+            os.utime(path, ns=(now, now))
+        except OSError as e:
+            logger.warning(f"Could not signal new messages for user {user_id}: {e}")
+
+    def wait(self, user_id, version, timeout):
+        """
+        Blocks until user_id's version moves past version, which the caller
+        read before querying, or timeout seconds pass. Returns True if it
+        moved, False on timeout, or None at once when every slot is taken.
+        """
+        if self.slots is not None and not self.slots.acquire(blocking=False):
+            return None
+        try:
+            return self._wait(user_id, version, timeout)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    def _wait(self, user_id, version, timeout):
+        local_version, stamp = version
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            entry = self.conditions.setdefault(user_id, [threading.Condition(self.lock), 0])
+            entry[1] += 1
+            try:
+                while True:
+                    if self.versions.get(user_id, 0) != local_version:
+                        return True
+                    if self.signal_stamp(user_id) != stamp:
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    entry[0].wait(min(remaining, self.signal_interval) if self.signal_dir else remaining)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.conditions[user_id]
+
+def init_messaging(app):
+    app.extensions['message_broker'] = MessageBroker(max_waiters=app.config.get('MESSAGE_POLL_MAX_WAITERS'),
+                                                     signal_dir=app.config.get('MESSAGE_SIGNAL_DIR'),
+                                                     signal_interval=app.config.get('MESSAGE_SIGNAL_INTERVAL', 1.0))
+
+def message_broker():
+    return current_app.extensions['message_broker']
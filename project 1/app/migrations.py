@@ -0,0 +1,370 @@
+import logging
+from sqlalchemy import bindparam, inspect, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema migrations. The database records the number of
+# migrations applied in schema_version, and `flask migrate` applies the
+# rest in order at deploy time, so starting the app only has to read one
+# row. New schema changes are appended as new @migration functions; never
+# reorder or edit ones that have shipped. Each migration spells out its own
+# DDL rather than reading the models or app.search, so replaying it on a
+# fresh database builds the schema as it was when it shipped.
+
+MIGRATIONS = []
+
+def migration(fn):
+    MIGRATIONS.append(fn)
+    return fn
+
+def add_columns(table, columns):
+    """Adds each column in columns, a mapping of name to SQL type, that table doesn't have yet."""
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table)}
+    with db.engine.begin() as conn:
+        for name, column_type in columns.items():
+            if name not in existing:
+                conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {column_type}'))
+
+def execute_all(statements):
+    with db.engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+def create_indexes(statements):
+    """Runs each CREATE INDEX on its own, so a unique index over duplicate rows doesn't stop the rest."""
+    for statement in statements:
+        try:
+            execute_all([statement])
+        except IntegrityError:
+            # Unique indexes can't be built over duplicate rows; reconcile-counters removes them
+            logger.warning(f"Could not create index ({' '.join(statement.split())}), run 'flask reconcile-counters'")
+
+BASELINE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS stored_file (
+        path VARCHAR(100) NOT NULL,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL,
+        date_created DATETIME NOT NULL,
+        PRIMARY KEY (path)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user (
+        id INTEGER NOT NULL,
+        username VARCHAR(20) NOT NULL,
+        email VARCHAR(120) NOT NULL,
+        password VARCHAR(60) NOT NULL,
+        role VARCHAR(10) NOT NULL,
+        profile_picture VARCHAR(100),
+        bio VARCHAR(200),
+        theme VARCHAR(50),
+        followers_count INTEGER DEFAULT '0' NOT NULL,
+        following_count INTEGER DEFAULT '0' NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (username),
+        UNIQUE (email)
+    )""",
+    """CREATE TABLE IF NOT EXISTS friendship (
+        id INTEGER NOT NULL,
+        follower_id INTEGER NOT NULL,
+        followed_id INTEGER NOT NULL,
+        date_created DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(follower_id) REFERENCES user (id),
+        FOREIGN KEY(followed_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS message (
+        id INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        date_sent DATETIME NOT NULL,
+        sender_id INTEGER NOT NULL,
+        recipient_id INTEGER NOT NULL,
+        read BOOLEAN,
+        PRIMARY KEY (id),
+        FOREIGN KEY(sender_id) REFERENCES user (id),
+        FOREIGN KEY(recipient_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS notification (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        date_created DATETIME NOT NULL,
+        read BOOLEAN,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS post (
+        id INTEGER NOT NULL,
+        title VARCHAR(100) NOT NULL,
+        content TEXT NOT NULL,
+        image VARCHAR(100),
+        video VARCHAR(100),
+        image_webp VARCHAR(100),
+        poster VARCHAR(100),
+        status VARCHAR(20) DEFAULT 'ready' NOT NULL,
+        date_posted DATETIME NOT NULL,
+        user_id INTEGER NOT NULL,
+        like_count INTEGER DEFAULT '0' NOT NULL,
+        dislike_count INTEGER DEFAULT '0' NOT NULL,
+        comment_count INTEGER DEFAULT '0' NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS comment (
+        id INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        date_posted DATETIME NOT NULL,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        like_count INTEGER DEFAULT '0' NOT NULL,
+        dislike_count INTEGER DEFAULT '0' NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES user (id),
+        FOREIGN KEY(post_id) REFERENCES post (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS report (
+        id INTEGER NOT NULL,
+        reported_user_id INTEGER,
+        reporter_user_id INTEGER NOT NULL,
+        post_id INTEGER,
+        reason TEXT NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        date_reported DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(reported_user_id) REFERENCES user (id),
+        FOREIGN KEY(reporter_user_id) REFERENCES user (id),
+        FOREIGN KEY(post_id) REFERENCES post (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS timeline_entry (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER NOT NULL,
+        author_id INTEGER NOT NULL,
+        date_posted DATETIME NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES user (id),
+        FOREIGN KEY(post_id) REFERENCES post (id),
+        FOREIGN KEY(author_id) REFERENCES user (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS "like" (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        post_id INTEGER,
+        comment_id INTEGER,
+        is_like BOOLEAN NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(user_id) REFERENCES user (id),
+        FOREIGN KEY(post_id) REFERENCES post (id),
+        FOREIGN KEY(comment_id) REFERENCES comment (id)
+    )""",
+]
+
+# Columns databases from before versioned migrations may lack, since
+# create_app() used to add them at start-up
+BASELINE_COLUMNS = {
+    'user': {'followers_count': "INTEGER DEFAULT '0' NOT NULL", 'following_count': "INTEGER DEFAULT '0' NOT NULL"},
+    'post': {'image_webp': 'VARCHAR(100)', 'poster': 'VARCHAR(100)', 'status': "VARCHAR(20) DEFAULT 'ready' NOT NULL",
+             'like_count': "INTEGER DEFAULT '0' NOT NULL", 'dislike_count': "INTEGER DEFAULT '0' NOT NULL",
+             'comment_count': "INTEGER DEFAULT '0' NOT NULL"},
+    'comment': {'like_count': "INTEGER DEFAULT '0' NOT NULL", 'dislike_count': "INTEGER DEFAULT '0' NOT NULL"},
+    'report': {'post_id': 'INTEGER'},
+}
+
+BASELINE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS ix_stored_file_refcount ON stored_file (refcount)',
+    'CREATE INDEX IF NOT EXISTS ix_friendship_followed ON friendship (followed_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_friendship_follower_followed ON friendship (follower_id, followed_id)',
+    'CREATE INDEX IF NOT EXISTS ix_message_recipient_sender_date ON message (recipient_id, sender_id, date_sent)',
+    'CREATE INDEX IF NOT EXISTS ix_message_sender_recipient_date ON message (sender_id, recipient_id, date_sent)',
+    'CREATE INDEX IF NOT EXISTS ix_notification_user_date ON notification (user_id, date_created)',
+    'CREATE INDEX IF NOT EXISTS ix_notification_user_read_date ON notification (user_id, read, date_created)',
+    'CREATE INDEX IF NOT EXISTS ix_post_date_posted_id ON post (date_posted, id)',
+    'CREATE INDEX IF NOT EXISTS ix_post_user_date ON post (user_id, date_posted, id)',
+    'CREATE INDEX IF NOT EXISTS ix_comment_post_date ON comment (post_id, date_posted, id)',
+    'CREATE INDEX IF NOT EXISTS ix_comment_user ON comment (user_id)',
+    'CREATE INDEX IF NOT EXISTS ix_report_post ON report (post_id)',
+    'CREATE INDEX IF NOT EXISTS ix_report_reported_user ON report (reported_user_id)',
+    'CREATE INDEX IF NOT EXISTS ix_report_status_date ON report (status, date_reported, id)',
+    'CREATE INDEX IF NOT EXISTS ix_timeline_post ON timeline_entry (post_id)',
+    'CREATE INDEX IF NOT EXISTS ix_timeline_user_author ON timeline_entry (user_id, author_id)',
+    'CREATE INDEX IF NOT EXISTS ix_timeline_user_date ON timeline_entry (user_id, date_posted, post_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_timeline_user_post ON timeline_entry (user_id, post_id)',
+    'CREATE INDEX IF NOT EXISTS ix_like_comment ON "like" (comment_id, is_like)',
+    'CREATE INDEX IF NOT EXISTS ix_like_post ON "like" (post_id, is_like)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_like_user_comment ON "like" (user_id, comment_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS uq_like_user_post ON "like" (user_id, post_id)',
+]
+
+@migration
+def baseline():
+    """Tables, columns and indexes as create_app() used to build at every start, before migrations."""
+    execute_all(BASELINE_TABLES)
+    for table, columns in BASELINE_COLUMNS.items():
+        add_columns(table, columns)
+    create_indexes(BASELINE_INDEXES)
+
+SEARCH_INDEX_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+        title, content, content='post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, content ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO post_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(
+        username, content='user', content_rowid='id', tokenize="unicode61 tokenchars '_'")""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON "user" BEGIN
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_update AFTER UPDATE OF username ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username);
+    END""",
+]
+
+@migration
+def search_index():
+    """FTS5 tables and triggers for search, where SQLite supports them."""
+    from app.search import init_search_index
+    init_search_index(SEARCH_INDEX_SCHEMA)
+
+@migration
+def post_text():
+    """Stored excerpt and rendered body columns on post, filled in for existing posts."""
+    add_columns('post', {'excerpt': 'VARCHAR(210)', 'content_html': 'TEXT'})
+    backfill_post_text(columns=('excerpt', 'content_html'))
+
+POST_TEXT_COLUMNS = ('excerpt', 'content_html', 'title_text', 'body_text')
+
+def backfill_post_text(batch_size=1000, columns=POST_TEXT_COLUMNS):
+    """
+    Fills the text derived from title and content (excerpt, content_html
+    and the search columns) for posts written without it, such as those
+    from before the columns existed or from bulk inserts, committing after
+    each batch. Migrations pass the columns that existed when they shipped.
+    Returns the number of posts updated.
+    """
+    from app.models import Post
+    from app.sanitize import make_excerpt, plain_text, render_content
+    derive = {
+        'excerpt': lambda title, content: make_excerpt(content),
+        'content_html': lambda title, content: render_content(content),
+        'title_text': lambda title, content: plain_text(title),
+        'body_text': lambda title, content: plain_text(content)
+    }
+    table = Post.__table__
+    statement = update(table).where(table.c.id == bindparam('post_id')) \
+        .values({column: bindparam(f'new_{column}') for column in columns})
+    missing = or_(*(table.c[column].is_(None) for column in columns))
+    updated = 0
+    while True:
+        rows = db.session.execute(select(table.c.id, table.c.title, table.c.content).where(missing)
+                                  .limit(batch_size)).all()
+        if not rows:
+            return updated
+        db.session.execute(statement, [dict({f'new_{column}': derive[column](title, content) for column in columns},
+                                            post_id=post_id) for post_id, title, content in rows])
+        db.session.commit()
+        updated += len(rows)
+
+USER_SEARCH_TOKENS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(
+        username, content='user', content_rowid='id', tokenize='unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON "user" BEGIN
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_update AFTER UPDATE OF username ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username);
+    END""",
+]
+
+@migration
+def user_search_tokens():
+    """Username search index rebuilt without tokenchars '_', so each part of a name is a token."""
+    from app.search import recreate_search_table
+    recreate_search_table('user_fts', USER_SEARCH_TOKENS_SCHEMA)
+
+@migration
+def post_html_sanitized():
+    """content_html rebuilt from the sanitized body; it used to hold an escaped copy that rendered double-encoded."""
+    from app.models import Post
+    db.session.execute(update(Post.__table__).values(content_html=None))
+    db.session.commit()
+    backfill_post_text(columns=('excerpt', 'content_html'))
+
+SEARCH_PLAIN_TEXT_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+        title_text, body_text, content='post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_fts(rowid, title_text, body_text) VALUES (new.id, new.title_text, new.body_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title_text, body_text)
+        VALUES ('delete', old.id, old.title_text, old.body_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title_text, body_text ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title_text, body_text)
+        VALUES ('delete', old.id, old.title_text, old.body_text);
+        INSERT INTO post_fts(rowid, title_text, body_text) VALUES (new.id, new.title_text, new.body_text);
+    END""",
+]
+
+@migration
+def search_plain_text():
+    """Plain-text title and body columns on post, and the post search index rebuilt over them."""
+    add_columns('post', {'title_text': 'VARCHAR(100)', 'body_text': 'TEXT'})
+    backfill_post_text(columns=('title_text', 'body_text'))
+    from app.search import recreate_search_table
+    recreate_search_table('post_fts', SEARCH_PLAIN_TEXT_SCHEMA)
+
+def latest_version():
+    return len(MIGRATIONS)
+
+def current_version():
+    if not inspect(db.engine).has_table('schema_version'):
+        return 0
+    with db.engine.connect() as conn:
+        return conn.execute(text('SELECT version FROM schema_version')).scalar() or 0
+
+def set_version(version):
+    with db.engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+        conn.execute(text('DELETE FROM schema_version'))
+        conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+
+def migrate():
+    """Applies pending migrations in order, recording each one. Returns the names applied."""
+    applied = []
+    for version in range(current_version(), latest_version()):
+        fn = MIGRATIONS[version]
+        logger.info(f"Applying migration {version + 1}: {fn.__name__}")
+        fn()
+        set_version(version + 1)
+        applied.append(fn.__name__)
+    return applied
+
+def check_schema(app):
+    """
+    Brings the schema up to date at startup when AUTO_MIGRATE is set, as in
+    development. Otherwise only reads the version and logs when a deploy
+    skipped `flask migrate`.
+    """
+    if app.config.get('AUTO_MIGRATE'):
+        migrate()
+        return
+    version = current_version()
+    if version < latest_version():
+        logger.error(f"Database schema is at version {version} but this code needs {latest_version()}, "
+                     f"run 'flask migrate'")
@@ -1,7 +1,8 @@
 from flask_login import UserMixin
 from datetime import datetime
-import bleach
+from sqlalchemy.orm import validates
 from app import db
+from app.sanitize import make_excerpt, plain_text, render_content
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -12,6 +13,8 @@ class User(UserMixin, db.Model):
     profile_picture = db.Column(db.String(100), nullable=True, default='default.jpg')
     bio = db.Column(db.String(200), nullable=True)
     theme = db.Column(db.String(50), nullable=True, default='light')
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     posts = db.relationship('Post', backref='author', lazy=True, cascade='all, delete-orphan')
     comments = db.relationship('Comment', backref='author', lazy=True, cascade='all, delete-orphan')
     sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy=True, cascade='all, delete-orphan')
@@ -24,21 +27,57 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    # Derived from content whenever it is set; list queries read these and defer the body
+    excerpt = db.Column(db.String(210), nullable=True)
+    content_html = db.Column(db.Text, nullable=True)
+    # Plain text of title and content for the search index, since both hold escaped bleach output
+    title_text = db.Column(db.String(100), nullable=True)
+    body_text = db.deferred(db.Column(db.Text, nullable=True))
     image = db.Column(db.String(100), nullable=True)
     video = db.Column(db.String(100), nullable=True)
+    image_webp = db.Column(db.String(100), nullable=True)
+    poster = db.Column(db.String(100), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready')
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    dislike_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     comments = db.relationship('Comment', backref='post', lazy=True, cascade='all, delete-orphan')
     likes = db.relationship('Like', backref='post', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_post_date_posted_id', 'date_posted', 'id'),
+        db.Index('ix_post_user_date', 'user_id', 'date_posted', 'id'),
+    )
+
+    @validates('title')
+    def derive_title_text(self, key, title):
+        self.title_text = plain_text(title)
+        return title
+
+    @validates('content')
+    def derive_text(self, key, content):
+        self.excerpt = make_excerpt(content)
+        self.content_html = render_content(content)
+        self.body_text = plain_text(content)
+        return content
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    dislike_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     likes = db.relationship('Like', backref='comment', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_comment_post_date', 'post_id', 'date_posted', 'id'),
+        db.Index('ix_comment_user', 'user_id'),
+    )
+
 class Like(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -46,6 +85,13 @@ class Like(db.Model):
     comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
     is_like = db.Column(db.Boolean, nullable=False)
 
+    __table_args__ = (
+        db.Index('uq_like_user_post', 'user_id', 'post_id', unique=True),
+        db.Index('uq_like_user_comment', 'user_id', 'comment_id', unique=True),
+        db.Index('ix_like_post', 'post_id', 'is_like'),
+        db.Index('ix_like_comment', 'comment_id', 'is_like'),
+    )
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -54,12 +100,36 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     read = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index('ix_message_sender_recipient_date', 'sender_id', 'recipient_id', 'date_sent'),
+        db.Index('ix_message_recipient_sender_date', 'recipient_id', 'sender_id', 'date_sent'),
+    )
+
 class Friendship(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('uq_friendship_follower_followed', 'follower_id', 'followed_id', unique=True),
+        db.Index('ix_friendship_followed', 'followed_id'),
+    )
+
+class TimelineEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    date_posted = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_timeline_user_date', 'user_id', 'date_posted', 'post_id'),
+        db.Index('uq_timeline_user_post', 'user_id', 'post_id', unique=True),
+        db.Index('ix_timeline_user_author', 'user_id', 'author_id'),
+        db.Index('ix_timeline_post', 'post_id'),
+    )
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -67,6 +137,11 @@ class Notification(db.Model):
     date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     read = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        db.Index('ix_notification_user_read_date', 'user_id', 'read', 'date_created'),
+        db.Index('ix_notification_user_date', 'user_id', 'date_created'),
+    )
+
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     reported_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
@@ -75,3 +150,19 @@ class Report(db.Model):
     reason = db.Column(db.Text, nullable=False)
     status = db.Column(db.String(20), nullable=False, default='Pending')
     date_reported = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_report_status_date', 'status', 'date_reported', 'id'),
+        db.Index('ix_report_post', 'post_id'),
+        db.Index('ix_report_reported_user', 'reported_user_id'),
+    )
+
+class StoredFile(db.Model):
+    path = db.Column(db.String(100), primary_key=True)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_stored_file_refcount', 'refcount'),
+    )
@@ -0,0 +1,85 @@
+from collections import namedtuple
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import Post, Report, User
+from app.pagination import keyset_page
+from app.purge import POST_COLUMNS, purge_posts
+
+REPORT_STATUSES = ('Pending', 'Resolved')
+
+ReportGroup = namedtuple('ReportGroup', 'post_id post_title user_id username reports last_reported')
+
+def report_queue(status='Pending', cursor=None, per_page=50):
+    """Returns (rows, next_cursor) for one page of reports with the given status, newest first."""
+    reported = aliased(User)
+    reporter = aliased(User)
+    query = db.session.query(
+        Report.id, Report.date_reported, Report.reason, Report.status, Report.post_id, Report.reported_user_id,
+        Post.title.label('post_title'),
+        reported.username.label('reported_username'),
+        reporter.username.label('reporter_username')
+    ).outerjoin(reported, Report.reported_user_id == reported.id) \
+     .outerjoin(reporter, Report.reporter_user_id == reporter.id) \
+     .outerjoin(Post, Report.post_id == Post.id) \
+     .filter(Report.status == status)
+    return keyset_page(query, Report.date_reported, Report.id, cursor=cursor, per_page=per_page)
+
+def report_groups(status='Pending', limit=20):
+    """
+    Counts reports per reported post (or per user, for reports about a user)
+    so the most reported content is handled first.
+    """
+    grouped = select(Report.post_id, Report.reported_user_id,
+                     func.count(Report.id).label('reports'),
+                     func.max(Report.date_reported).label('last_reported')) \
+        .where(Report.status == status) \
+        .group_by(Report.post_id, Report.reported_user_id).subquery()
+    rows = db.session.execute(
+        select(grouped.c.post_id, Post.title, grouped.c.reported_user_id, User.username,
+               grouped.c.reports, grouped.c.last_reported)
+        .outerjoin(Post, Post.id == grouped.c.post_id)
+        .outerjoin(User, User.id == grouped.c.reported_user_id)
+        .order_by(grouped.c.reports.desc(), grouped.c.last_reported.desc())
+        .limit(limit)
+    ).all()
+    return [ReportGroup(*row) for row in rows]
+
+def status_counts():
+    return dict(db.session.query(Report.status, func.count(Report.id)).group_by(Report.status).all())
+
+def resolve_reports(report_ids=(), post_ids=(), user_ids=()):
+    """
+    Marks pending reports resolved with one UPDATE, selected by report id,
+    by reported post, or by reported user (user reports only). Returns the
+    number of reports resolved. Runs in the caller's transaction.
+    """
+    conditions = []
+    if report_ids:
+        conditions.append(Report.id.in_(report_ids))
+    if post_ids:
+        conditions.append(Report.post_id.in_(post_ids))
+    if user_ids:
+        conditions.append(Report.reported_user_id.in_(user_ids) & Report.post_id.is_(None))
+    if not conditions:
+        return 0
+    result = db.session.execute(update(Report).where(Report.status == 'Pending', or_(*conditions))
+                                .values(status='Resolved').execution_options(synchronize_session=False))
+    return result.rowcount
+
+def deletable_posts(moderator, post_ids):
+    """Returns the posts among post_ids that moderator may delete, as plain rows."""
+    query = db.session.query(*POST_COLUMNS).filter(Post.id.in_(post_ids))
+    if moderator.role == 'Admin':
+        # Admins can only delete posts by Users
+        query = query.join(User, User.id == Post.user_id).filter(User.role == 'User')
+    elif moderator.role != 'Manager':
+        return []
+    return query.all()
+
+def delete_posts(moderator, post_ids):
+    """
+    Deletes the posts moderator may delete, with their comments, likes and
+    timeline entries, in the caller's transaction. Returns the ids deleted.
+    """
+    return purge_posts(deletable_posts(moderator, post_ids))
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Response, current_app, request, session
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from app import db
+from app.cache import DiskCache, LRUCache
+from app.models import Comment, Friendship, Like, Post, User
+
+# Each cached page records the version of every tag it depends on when it
+# was rendered. Writes bump tag versions after commit, which makes every
+# page depending on that tag a miss without having to find and delete it.
+# Tag versions live in their own store that never evicts, so churn among
+# pages can't make a tag fall back to a version an old page recorded.
+
+def page_size(value):
+    return len(value['body']) if isinstance(value, dict) else 64
+
+class TagVersions:
+    """Current version of each tag. A tag not seen before starts at a fresh version."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+
+    def get(self, tags):
+        versions = {}
+        with self.lock:
+            for tag in tags:
+                version = self.backend.get(tag_key(tag))
+                if version is None:
+                    version = time.time_ns()
+                    self.backend.set(tag_key(tag), version, ttl=0)
+                versions[tag] = version
+        return versions
+
+    def bump(self, tags):
+        version = time.time_ns()
+        with self.lock:
+            for tag in tags:
+                self.backend.set(tag_key(tag), version, ttl=0)
+
+def init_page_cache(app):
+    if not app.config.get('PAGE_CACHE_ENABLED', True):
+        return
+    if app.config.get('PAGE_CACHE_BACKEND') == 'disk':
+        folder = app.config['PAGE_CACHE_DIR']
+        backend = DiskCache(folder, ttl=app.config.get('PAGE_CACHE_TTL', 300),
+                            max_bytes=app.config.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+        tags = DiskCache(os.path.join(folder, 'tags'), ttl=0)
+    else:
+        backend = LRUCache(maxsize=app.config.get('PAGE_CACHE_SIZE', 5000),
+                           ttl=app.config.get('PAGE_CACHE_TTL', 300),
+                           max_bytes=app.config.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                           size_of=page_size)
+        tags = LRUCache(maxsize=float('inf'), ttl=0)
+    app.extensions['page_cache'] = backend
+    app.extensions['page_cache_tags'] = TagVersions(tags)
+
+def page_cache():
+    return current_app.extensions.get('page_cache')
+
+def tag_key(tag):
+    return f'tag:{tag}'
+
+def tag_versions(tags):
+    return current_app.extensions['page_cache_tags'].get(tags)
+
+def bump_tags(tags):
+    if page_cache() is None:
+        return
+    current_app.extensions['page_cache_tags'].bump(tags)
+
+def invalidate(*tags):
+    """
+    Marks pages depending on tags as stale once the current transaction
+    commits. Bulk UPDATE/DELETE statements skip mapper events, so code
+    issuing them calls this directly.
+    """
+    db.session.info.setdefault('page_cache_tags', set()).update(tags)
+
+def invalidate_all():
+    invalidate('all')
+
+def tags_for(target):
+    if isinstance(target, Post):
+        return {'posts', f'post:{target.id}', f'user:{target.user_id}'}
+    if isinstance(target, Comment):
+        return {f'post:{target.post_id}'}
+    if isinstance(target, Like):
+        return {f'post:{target.post_id}'} if target.post_id else set()
+    if isinstance(target, User):
+        return {'users', f'user:{target.id}'}
+    if isinstance(target, Friendship):
+        return {f'user:{target.follower_id}', f'user:{target.followed_id}'}
+    return set()
+
+def record_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('page_cache_tags', set()).update(tags_for(target))
+
+for model in (Post, Comment, Like, User, Friendship):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, record_change)
+
+@event.listens_for(db.session, 'after_commit')
+def bump_committed_tags(session):
+    tags = session.info.pop('page_cache_tags', None)
+    if tags:
+        bump_tags(tags)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_pending_tags(session):
+    session.info.pop('page_cache_tags', None)
+
+def cacheable_request():
+    return (request.method == 'GET'
+            and not current_user.is_authenticated
+            and '_flashes' not in session)
+
+def cached_page(tags, query_args=('cursor',)):
+    """
+    Caches a view's response for anonymous GET requests. tags is called
+    with the view's arguments and returns the tags the page depends on.
+    Only the query arguments in query_args, which the view reads, go into
+    the key; requests carrying any other argument aren't cached, so made-up
+    query strings can't fill the cache. Responses carry an ETag and
+    Last-Modified so browsers can revalidate.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = page_cache()
+            if cache is None or not cacheable_request() or any(name not in query_args for name in request.args):
+                return view(*args, **kwargs)
+
+            depends_on = set(tags(*args, **kwargs)) | {'all'}
+            xhr = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+            key = f'page:{int(xhr)}:{request.path}?{urlencode(sorted(request.args.items(multi=True)))}'
+            entry = cache.get(key)
+            if entry is not None and entry['tags'] == tag_versions(depends_on):
+                return build_response(entry)
+
+            # Capture versions before rendering so a write during rendering isn't masked
+            versions = tag_versions(depends_on)
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough or 'Set-Cookie' in response.headers:
+                return response
+            body = response.get_data()
+            entry = {
+                'body': body,
+                'mimetype': response.mimetype,
+                'etag': hashlib.md5(body).hexdigest(),
+                'last_modified': time.time(),
+                'tags': versions
+            }
+            cache.set(key, entry)
+            return build_response(entry)
+        return wrapper
+    return decorator
+
+def build_response(entry):
+    response = Response(entry['body'], mimetype=entry['mimetype'])
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['last_modified']
+    response.headers['Cache-Control'] = 'public, no-cache'
+    response.vary.add('Cookie')
+    response.vary.add('X-Requested-With')
+    return response.make_conditional(request)
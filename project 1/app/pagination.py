@@ -0,0 +1,45 @@
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+def encode_cursor(dt, row_id):
+    return f"{dt.isoformat()}_{row_id}"
+
+def decode_cursor(cursor):
+    """
+    Returns the (datetime, id) pair stored in a cursor string,
+    or None if the cursor is missing or malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        stamp, row_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(stamp), int(row_id)
+    except ValueError:
+        return None
+
+def keyset_page(query, date_column, id_column, cursor=None, per_page=20, descending=True):
+    """
+    Returns (rows, next_cursor) for the page of `query` that follows `cursor`,
+    ordered by (date_column, id_column). next_cursor is None on the last page.
+    """
+    position = decode_cursor(cursor)
+    if position:
+        dt, row_id = position
+        if descending:
+            query = query.filter(or_(date_column < dt, and_(date_column == dt, id_column < row_id)))
+        else:
+            query = query.filter(or_(date_column > dt, and_(date_column == dt, id_column > row_id)))
+
+    if descending:
+        query = query.order_by(date_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(date_column.asc(), id_column.asc())
+
+    # Fetch one extra row to know whether another page exists
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, date_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
@@ -0,0 +1,210 @@
+import logging
+import queue
+import threading
+from flask import current_app
+from sqlalchemy import delete, func, or_, select, update
+from app import db
+from app.accounts import DISABLED_ROLE, invalidate_session_user
+from app.badges import invalidate_unread
+from app.models import Comment, Friendship, Like, Message, Notification, Post, Report, TimelineEntry, User
+from app.page_cache import invalidate
+from app.storage import release_many, request_sweep
+
+logger = logging.getLogger(__name__)
+
+# Accounts and posts are removed with set-based DELETEs in dependency order
+# rather than db.session.delete(), whose cascades load every dependent row
+# into the session first. Accounts are purged in chunks with a commit after
+# each one, so writers are never locked out for long and an interrupted
+# purge can simply be run again.
+
+PURGE_CHUNK_SIZE = 500
+PURGE_INLINE_ROWS = 2000
+POST_COLUMNS = (Post.id, Post.user_id, Post.image, Post.image_webp, Post.video, Post.poster)
+
+def purge_posts(posts):
+    """
+    Deletes posts, given as rows with the POST_COLUMNS, with their comments,
+    likes and timeline entries in the caller's transaction. Their uploads are
+    released for the sweeper. Returns the ids deleted.
+    """
+    ids = [post.id for post in posts]
+    if not ids:
+        return []
+    comment_ids = select(Comment.id).where(Comment.post_id.in_(ids))
+    db.session.execute(delete(Like).where(Like.comment_id.in_(comment_ids)))
+    db.session.execute(delete(Like).where(Like.post_id.in_(ids)))
+    db.session.execute(delete(Comment).where(Comment.post_id.in_(ids)))
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.post_id.in_(ids)))
+    db.session.execute(delete(Post).where(Post.id.in_(ids)).execution_options(synchronize_session=False))
+    release_many(filename for post in posts for filename in (post.image, post.image_webp, post.video, post.poster))
+    invalidate('posts', *{f'post:{post.id}' for post in posts}, *{f'user:{post.user_id}' for post in posts})
+    return ids
+
+def delete_in_chunks(model, condition, chunk_size=PURGE_CHUNK_SIZE, before=None):
+    """
+    Deletes the rows of model matching condition chunk_size at a time,
+    committing after each chunk. before(ids) runs first in each chunk's
+    transaction, for updates that depend on the rows being deleted.
+    Returns the number of rows removed.
+    """
+    removed = 0
+    while True:
+        ids = db.session.scalars(select(model.id).where(condition).limit(chunk_size)).all()
+        if not ids:
+            return removed
+        if before is not None:
+            before(ids)
+        db.session.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False))
+        db.session.commit()
+        removed += len(ids)
+
+def uncount_follows(ids):
+    followed = select(Friendship.followed_id).where(Friendship.id.in_(ids))
+    followers = select(Friendship.follower_id).where(Friendship.id.in_(ids))
+    db.session.execute(update(User).where(User.id.in_(followed))
+                       .values(followers_count=User.followers_count - 1)
+                       .execution_options(synchronize_session=False))
+    db.session.execute(update(User).where(User.id.in_(followers))
+                       .values(following_count=User.following_count - 1)
+                       .execution_options(synchronize_session=False))
+
+def uncount_likes(ids):
+    """Takes the likes and dislikes in ids off the posts and comments they were on."""
+    for model, target in ((Post, Like.post_id), (Comment, Like.comment_id)):
+        def tally(is_like):
+            return select(func.count(Like.id)).where(Like.id.in_(ids), target == model.id,
+                                                     Like.is_like == is_like).scalar_subquery()
+        liked = select(target).where(Like.id.in_(ids))
+        db.session.execute(update(model).where(model.id.in_(liked))
+                           .values(like_count=model.like_count - tally(True),
+                                   dislike_count=model.dislike_count - tally(False))
+                           .execution_options(synchronize_session=False))
+    post_ids = db.session.scalars(select(Like.post_id).where(Like.id.in_(ids), Like.post_id.isnot(None)).distinct())
+    invalidate(*(f'post:{post_id}' for post_id in post_ids))
+
+def remove_comments(ids):
+    """Deletes the likes on the comments in ids and takes the comments off their posts' counts."""
+    commented = select(Comment.post_id).where(Comment.id.in_(ids))
+    tally = select(func.count(Comment.id)).where(Comment.id.in_(ids), Comment.post_id == Post.id).scalar_subquery()
+    db.session.execute(update(Post).where(Post.id.in_(commented))
+                       .values(comment_count=Post.comment_count - tally)
+                       .execution_options(synchronize_session=False))
+    db.session.execute(delete(Like).where(Like.comment_id.in_(ids)))
+    invalidate(*(f'post:{post_id}' for post_id in db.session.scalars(commented.distinct())))
+
+def disable_account(user_id):
+    """Locks user_id out before their purge, so they can't log in or keep posting meanwhile."""
+    db.session.execute(update(User).where(User.id == user_id).values(role=DISABLED_ROLE)
+                       .execution_options(synchronize_session=False))
+    invalidate('users', f'user:{user_id}')
+    db.session.commit()
+    invalidate_session_user(user_id)
+
+def purge_user(user_id, chunk_size=PURGE_CHUNK_SIZE):
+    """
+    Deletes a user and everything that depends on them, keeping other
+    users' counters right. Returns the number of posts removed, or None if
+    the user no longer exists.
+    """
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    profile_picture = user.profile_picture
+    db.session.expunge(user)
+    disable_account(user_id)
+
+    delete_in_chunks(Friendship, or_(Friendship.follower_id == user_id, Friendship.followed_id == user_id),
+                     chunk_size, before=uncount_follows)
+    delete_in_chunks(Like, Like.user_id == user_id, chunk_size, before=uncount_likes)
+    delete_in_chunks(Comment, Comment.user_id == user_id, chunk_size, before=remove_comments)
+    posts_removed = 0
+    while True:
+        posts = db.session.query(*POST_COLUMNS).filter(Post.user_id == user_id).limit(chunk_size).all()
+        if not posts:
+            break
+        purge_posts(posts)
+        db.session.commit()
+        request_sweep()
+        posts_removed += len(posts)
+    # Entries for the user's posts went with the posts, leaving the user's own timeline
+    delete_in_chunks(TimelineEntry, TimelineEntry.user_id == user_id, chunk_size)
+
+    def forget_unread(ids):
+        recipients = db.session.scalars(select(Message.recipient_id).where(
+            Message.id.in_(ids), Message.sender_id == user_id, Message.read == False).distinct())
+        for recipient_id in recipients:
+            invalidate_unread('messages', recipient_id)
+    delete_in_chunks(Message, or_(Message.sender_id == user_id, Message.recipient_id == user_id),
+                     chunk_size, before=forget_unread)
+    delete_in_chunks(Notification, Notification.user_id == user_id, chunk_size)
+    delete_in_chunks(Report, Report.reporter_user_id == user_id, chunk_size)
+
+    db.session.execute(update(Report).where(Report.status == 'Pending', Report.reported_user_id == user_id)
+                       .values(status='Resolved').execution_options(synchronize_session=False))
+    # Posts from requests that were already under way when the account was disabled
+    posts_removed += len(purge_posts(db.session.query(*POST_COLUMNS).filter(Post.user_id == user_id).all()))
+    release_many([profile_picture])
+    db.session.execute(delete(User).where(User.id == user_id))
+    invalidate('users', f'user:{user_id}')
+    db.session.commit()
+    invalidate_session_user(user_id)
+    request_sweep()
+    return posts_removed
+
+def account_size(user_id):
+    """Rough number of rows a purge of user_id deletes, counting the tables that grow with activity."""
+    return sum(db.session.query(func.count(column)).filter(column == user_id).scalar()
+               for column in (Post.user_id, Comment.user_id, Like.user_id, Message.sender_id, Friendship.followed_id))
+
+class PurgeWorker:
+    """
+    Background thread that purges large accounts one at a time. Started on
+    first use so forked workers each get their own. A purge cut short by a
+    restart is finished by running `flask purge-user` for the account.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, user_id):
+        with self.lock:
+            if user_id in self.pending:
+                return
+            self.pending.add(user_id)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='account-purge', daemon=True)
+                self.thread.start()
+        self.queue.put(user_id)
+
+    def _run(self):
+        while True:
+            user_id = self.queue.get()
+            try:
+                with self.app.app_context():
+                    posts = purge_user(user_id)
+                logger.info(f"Purged user {user_id} and {posts} posts in the background")
+            except Exception as e:
+                logger.error(f"Purge of user {user_id} failed: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(user_id)
+
+def init_purge(app):
+    app.extensions['purge_worker'] = PurgeWorker(app)
+
+def delete_account(user_id):
+    """
+    Purges user_id now if the account is small, otherwise hands it to the
+    background worker. Returns True if the purge was deferred.
+    """
+    if account_size(user_id) <= current_app.config.get('PURGE_INLINE_ROWS', PURGE_INLINE_ROWS):
+        purge_user(user_id)
+        return False
+    disable_account(user_id)
+    current_app.extensions['purge_worker'].submit(user_id)
+    return True
@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select
+from app import db
+from app.models import Notification
+
+def compact_notifications(older_than_days=90, batch_size=1000):
+    """
+    Deletes read notifications older than the cutoff in batches, committing
+    after each one so writers are never locked out for long. Returns the
+    number of rows removed.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    removed = 0
+    while True:
+        batch = select(Notification.id).where(
+            Notification.read == True, Notification.date_created < cutoff
+        ).limit(batch_size)
+        result = db.session.execute(delete(Notification).where(Notification.id.in_(batch))
+                                    .execution_options(synchronize_session=False))
+        db.session.commit()
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            return removed
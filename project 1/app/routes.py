@@ -1,12 +1,26 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, current_app
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, current_app, abort, send_from_directory
 from flask_login import login_required, current_user
 from app.models import Post, Comment, Like, Message, Friendship, Notification, User, Report
 from app import db
-import os
-from werkzeug.utils import secure_filename
-import ffmpeg
-import bleach
-from werkzeug.security import generate_password_hash
+from app.sanitize import clean
+from app.pagination import keyset_page
+from app.fanout import announce_post
+from app.media import submit_post_media
+from app.storage import UploadTooLarge, release_many, upload_url, is_content_addressed, request_sweep
+from app.uploads import read_upload_form
+from app.assets import send_asset
+from app.moderation import REPORT_STATUSES, report_queue, report_groups, status_counts, resolve_reports, delete_posts
+from app.counters import increment, like_count_column
+from app.search import search_posts, search_users
+from app.messaging import conversation_summaries, conversation_page, messages_since, mark_conversation_read, message_broker
+from app.page_cache import cached_page
+from app.timeline import timeline_page, backfill_timeline, trim_timeline
+from app.purge import POST_COLUMNS, purge_posts, delete_account
+from app.suggestions import suggestions_page, invalidate_suggestions
+from app.badges import bump_unread, reset_unread, invalidate_unread, unread_counts
+from app.accounts import LoginThrottled, hash_password
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer, joinedload
 
 main = Blueprint('main', __name__)
 
@@ -15,35 +29,78 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'mp4', 'mov'}
 MAX_IMAGE_SIZE = 8 * 1024 * 1024  # 8 MB
 MAX_VIDEO_SIZE = 8 * 1024 * 1024  # 8 MB
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def validate_video_duration(filepath):
-    try:
-        probe = ffmpeg.probe(filepath)
-        duration = float(probe['format']['duration'])
-        return duration <= 1200  # 20 minutes
-    except:
-        return False
+POSTS_PER_PAGE = 20
+SEARCH_RESULTS_PER_PAGE = 20
+CONVERSATIONS_PER_PAGE = 30
+MESSAGES_PER_PAGE = 50
+TYPEAHEAD_LIMIT = 10
+NOTIFICATIONS_PER_PAGE = 30
+MODERATION_PER_PAGE = 50
+REPORT_GROUPS_SHOWN = 20
+COMMENTS_PER_PAGE = 50
+PROFILE_POSTS_PER_PAGE = 20
+SUGGESTIONS_PER_PAGE = 20
+MEDIA_CACHE_SECONDS = 365 * 24 * 3600
+LEGACY_MEDIA_CACHE_SECONDS = 3600
+MESSAGE_POLL_RETRY_SECONDS = 5
+
+def is_following(follower_id, followed_id):
+    return db.session.query(
+        Friendship.query.filter_by(follower_id=follower_id, followed_id=followed_id).exists()
+    ).scalar()
 
 def create_notification(user_id, content):
-    content = bleach.clean(content)
+    content = clean(content)
     notification = Notification(user_id=user_id, content=content)
     db.session.add(notification)
     db.session.commit()
+    bump_unread('notifications', notification.user_id)
+
+def serialize_post(post):
+    return {
+        'id': post.id,
+        'title': post.title,
+        'excerpt': post.excerpt,
+        'url': url_for('main.post', post_id=post.id),
+        'author_id': post.author.id,
+        'author_username': post.author.username,
+        'author_url': url_for('main.profile', user_id=post.author.id),
+        'author_profile_picture': upload_url(post.author.profile_picture),
+        'date_posted': current_app.jinja_env.filters['time_since'](post.date_posted),
+        'image': upload_url(post.image) if post.image else None,
+        'image_webp': upload_url(post.image_webp) if post.image_webp else None,
+        'video': upload_url(post.video) if post.video else None,
+        'poster': upload_url(post.poster) if post.poster else None
+    }
 
 @main.route('/')
+@cached_page(lambda: ['posts', 'users'])
 def index():
-    posts = Post.query.order_by(Post.date_posted.desc()).all()
-    return render_template('index.html', posts=posts)
+    query = Post.query.options(joinedload(Post.author), defer(Post.content), defer(Post.content_html)) \
+        .filter(Post.status == 'ready')
+    posts, next_cursor = keyset_page(query, Post.date_posted, Post.id,
+                                     cursor=request.args.get('cursor'), per_page=POSTS_PER_PAGE)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'posts': [serialize_post(post) for post in posts], 'next_cursor': next_cursor})
+    return render_template('index.html', posts=posts, next_cursor=next_cursor)
+
+@main.route('/timeline')
+@login_required
+def timeline():
+    posts, next_cursor = timeline_page(current_user.id, cursor=request.args.get('cursor'), per_page=POSTS_PER_PAGE)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'posts': [serialize_post(post) for post in posts], 'next_cursor': next_cursor})
+    return render_template('index.html', posts=posts, next_cursor=next_cursor,
+                           heading='Following', feed_endpoint='main.timeline')
 
 @main.route('/dashboard')
 @login_required
 def dashboard():
+    query = Post.query.options(joinedload(Post.author), defer(Post.content), defer(Post.content_html))
     if current_user.role == 'Admin':
-        posts = Post.query.all()
+        posts = query.all()
     else:
-        posts = Post.query.filter_by(user_id=current_user.id).all()
+        posts = query.filter_by(user_id=current_user.id).all()
     return render_template('dashboard.html', posts=posts)
 
 @main.route('/post/new', methods=['GET', 'POST'])
@@ -54,142 +111,219 @@ def new_post():
         return redirect(url_for('main.index'))
     
     if request.method == 'POST':
-        title = bleach.clean(request.form['title'])
-        content = bleach.clean(request.form['content'])
-        image = request.files.get('image')
-        video = request.files.get('video')
-        image_filename = video_filename = None
-
-        if image and allowed_file(image.filename):
-            if image.content_length and image.content_length > MAX_IMAGE_SIZE:
-                flash('Image must be 8MB or less.', 'danger')
-                return redirect(url_for('main.new_post'))
-            image_filename = secure_filename(image.filename)
-            image.save(os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename))
-
-        if video and allowed_file(video.filename):
-            if video.content_length and video.content_length > MAX_VIDEO_SIZE:
-                flash('Video must be 8MB or less.', 'danger')
-                return redirect(url_for('main.new_post'))
-            video_filename = secure_filename(video.filename)
-            temp_path = os.path.join(current_app.config['UPLOAD_FOLDER'], video_filename)
-            video.save(temp_path)
-            if not validate_video_duration(temp_path):
-                flash('Video must be 60 seconds or less', 'danger')
-                return redirect(url_for('main.new_post'))
-        
-        post = Post(title=title, content=content, image=image_filename, video=video_filename, author=current_user)
+        try:
+            form, uploads = read_upload_form({'image': MAX_IMAGE_SIZE, 'video': MAX_VIDEO_SIZE}, ALLOWED_EXTENSIONS,
+                                              required=('title', 'content'))
+        except UploadTooLarge as e:
+            flash(f'{e.field.capitalize()} must be {e.limit // (1024 * 1024)}MB or less.', 'danger')
+            return redirect(url_for('main.new_post'))
+        title = clean(form['title'])
+        content = clean(form['content'])
+        image_filename = uploads['image'].commit() if 'image' in uploads else None
+        video_filename = uploads['video'].commit() if 'video' in uploads else None
+
+        has_media = bool(image_filename or video_filename)
+        post = Post(title=title, content=content, image=image_filename, video=video_filename, user_id=current_user.id,
+                    status='processing' if has_media else 'ready')
         db.session.add(post)
         db.session.commit()
-        
-        followers = Friendship.query.filter_by(followed_id=current_user.id).all()
-        for follower in followers:
-            create_notification(follower.follower_id, f"{current_user.username} posted a new blog: {title}")
-        
-        flash('Post created!', 'success')
+
+        if has_media:
+            # Probing, transcoding and resizing happen off the request; the post goes live when they finish
+            submit_post_media(post, image_filename, video_filename)
+            flash('Post created! It will appear once its media has been processed.', 'success')
+        else:
+            announce_post(post)
+            flash('Post created!', 'success')
         return redirect(url_for('main.index'))
     
     return render_template('create_post.html')
 
+def serialize_comment(comment):
+    return {
+        'id': comment.id,
+        'author_id': comment.author.id,
+        'author_username': comment.author.username,
+        'author_profile_picture': upload_url(comment.author.profile_picture),
+        'content': comment.content,
+        'date_posted': current_app.jinja_env.filters['time_since'](comment.date_posted)
+    }
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'content': message.content,
+        'sender_id': message.sender_id,
+        'sender_username': message.sender.username,
+        'sender_profile_picture': upload_url(message.sender.profile_picture),
+        'date_sent': current_app.jinja_env.filters['time_since'](message.date_sent)
+    }
+
+def comments_page(post_id, cursor=None):
+    query = Comment.query.options(joinedload(Comment.author)).filter(Comment.post_id == post_id)
+    return keyset_page(query, Comment.date_posted, Comment.id, cursor=cursor,
+                       per_page=COMMENTS_PER_PAGE, descending=False)
+
 @main.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@cached_page(lambda post_id: [f'post:{post_id}', 'users'])
 def post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(joinedload(Post.author)).filter_by(id=post_id).first_or_404()
+    if post.status != 'ready' and not (current_user.is_authenticated and current_user.id == post.user_id):
+        abort(404)
     if request.method == 'POST' and current_user.is_authenticated:
-        content = bleach.clean(request.form['content'])
-        comment = Comment(content=content, post=post, author=current_user)
+        content = clean(request.form['content'])
+        comment = Comment(content=content, post_id=post.id, user_id=current_user.id)
         db.session.add(comment)
+        increment(Post, post.id, comment_count=1)
         db.session.commit()
-        if post.author.id != current_user.id:
-            create_notification(post.author.id, f"{current_user.username} commented on your post: {post.title}")
+        if post.user_id != current_user.id:
+            create_notification(post.user_id, f"{current_user.username} commented on your post: {post.title}")
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-            return jsonify({
-                'author_id': current_user.id,
-                'author_username': current_user.username,
-                'author_profile_picture': url_for('static', filename='uploads/' + current_user.profile_picture),
-                'content': comment.content,
-                'date_posted': comment.date_posted.strftime('%b %d, %Y %H:%M')
-            })
+            return jsonify(serialize_comment(comment))
         flash('Comment added!', 'success')
         return redirect(url_for('main.post', post_id=post_id))
-    return render_template('post.html', post=post)
+    comments, next_cursor = comments_page(post_id)
+    viewer_like = None
+    if current_user.is_authenticated:
+        viewer_like = Like.query.filter_by(user_id=current_user.id, post_id=post_id).first()
+    return render_template('post.html', post=post, comments=comments, next_cursor=next_cursor, viewer_like=viewer_like)
+
+@main.route('/post/<int:post_id>/comments')
+def post_comments(post_id):
+    post = Post.query.get_or_404(post_id)
+    if post.status != 'ready' and not (current_user.is_authenticated and current_user.id == post.user_id):
+        abort(404)
+    comments, next_cursor = comments_page(post_id, cursor=request.args.get('cursor'))
+    return jsonify({'comments': [serialize_comment(comment) for comment in comments], 'next_cursor': next_cursor})
 
 @main.route('/like/<int:post_id>/<action>')
 @login_required
 def like_action(post_id, action):
     post = Post.query.get_or_404(post_id)
     like = Like.query.filter_by(user_id=current_user.id, post_id=post_id).first()
-    
-    if action == 'like' and not like:
-        db.session.add(Like(user_id=current_user.id, post_id=post_id, is_like=True))
-        if post.author.id != current_user.id:
-            create_notification(post.author.id, f"{current_user.username} liked your post: {post.title}")
-    elif action == 'dislike' and not like:
-        db.session.add(Like(user_id=current_user.id, post_id=post_id, is_like=False))
-        if post.author.id != current_user.id:
-            create_notification(post.author.id, f"{current_user.username} disliked your post: {post.title}")
-    elif like:
-        db.session.delete(like)
-    db.session.commit()
+    notification = None
+
+    try:
+        if action in ('like', 'dislike') and not like:
+            is_like = action == 'like'
+            db.session.add(Like(user_id=current_user.id, post_id=post_id, is_like=is_like))
+            db.session.flush()
+            increment(Post, post_id, **{like_count_column(is_like): 1})
+            if post.user_id != current_user.id:
+                notification = f"{current_user.username} {action}d your post: {post.title}"
+        elif like:
+            # Only decrement if this request is the one that removed the row
+            if Like.query.filter_by(id=like.id).delete(synchronize_session=False):
+                increment(Post, post_id, **{like_count_column(like.is_like): -1})
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request already recorded this user's like
+        db.session.rollback()
+        notification = None
+    if notification:
+        create_notification(post.user_id, notification)
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        likes = len([l for l in post.likes if l.is_like])
-        dislikes = len([l for l in post.likes if not l.is_like])
+        likes, dislikes = db.session.query(Post.like_count, Post.dislike_count).filter_by(id=post_id).one()
         return jsonify({'likes': likes, 'dislikes': dislikes})
 
     return redirect(request.referrer or url_for('main.index'))
 
 @main.route('/search', methods=['GET', 'POST'])
 def search():
-    if request.method == 'POST':
-        query = bleach.clean(request.form['query'])
-        posts = Post.query.filter(Post.title.ilike(f'%{query}%') | Post.content.ilike(f'%{query}%')).all()
-        users = User.query.filter(User.username.ilike(f'%{query}%')).all()
-        return render_template('search.html', posts=posts, users=users, query=query)
-    return render_template('search.html', posts=[], users=[], query='')
+    query = clean(request.values.get('query', '')).strip()
+    if not query:
+        return render_template('search.html', posts=[], users=[], snippets={}, query='', page=1, has_next=False)
+    page = max(request.args.get('page', 1, type=int), 1)
+    posts, snippets, has_next = search_posts(query, page=page, per_page=SEARCH_RESULTS_PER_PAGE)
+    users = search_users(query) if page == 1 else []
+    return render_template('search.html', posts=posts, users=users, snippets=snippets,
+                           query=query, page=page, has_next=has_next)
 
 @main.route('/inbox', methods=['GET', 'POST'])
 @login_required
 def inbox():
     if request.method == 'POST':
-        recipient_id = request.form['recipient_id']
-        content = bleach.clean(request.form['content'])
-        recipient = User.query.get_or_404(recipient_id)
-        message = Message(content=content, sender_id=current_user.id, recipient_id=recipient_id)
+        recipient_id = request.form.get('recipient_id')
+        if recipient_id:
+            recipient = User.query.get_or_404(recipient_id)
+        else:
+            recipient = User.query.filter_by(username=request.form.get('recipient_username', '')).first_or_404()
+        content = clean(request.form['content'])
+        message = Message(content=content, sender_id=current_user.id, recipient_id=recipient.id)
         db.session.add(message)
         db.session.commit()
-        create_notification(recipient_id, f"{current_user.username} sent you a message")
+        bump_unread('messages', recipient.id)
+        message_broker().publish(recipient.id, current_user.id)
+        create_notification(recipient.id, f"{current_user.username} sent you a message")
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'message': serialize_message(message)})
         flash('Message sent!', 'success')
         return redirect(url_for('main.inbox'))
-    
-    messages = Message.query.filter(
-        (Message.sender_id == current_user.id) | (Message.recipient_id == current_user.id)
-    ).order_by(Message.date_sent.desc()).all()
-    users = User.query.filter(User.id != current_user.id).all()
-    return render_template('inbox.html', messages=messages, users=users)
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    conversations, has_next = conversation_summaries(current_user.id, page=page, per_page=CONVERSATIONS_PER_PAGE)
+    return render_template('inbox.html', conversations=conversations, page=page, has_next=has_next)
+
+@main.route('/users/typeahead')
+@login_required
+def user_typeahead():
+    query = request.args.get('q', '').strip()
+    users = [user for user in search_users(query, limit=TYPEAHEAD_LIMIT + 1) if user.id != current_user.id]
+    return jsonify([{'id': user.id, 'username': user.username} for user in users[:TYPEAHEAD_LIMIT]])
 
 @main.route('/conversation/<int:user_id>')
 @login_required
 def conversation(user_id):
     other_user = User.query.get_or_404(user_id)
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.recipient_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.recipient_id == current_user.id))
-    ).order_by(Message.date_sent.asc()).all()
-    
-    for message in messages:
-        if message.recipient_id == current_user.id and not message.read:
-            message.read = True
-    db.session.commit()
-    
-    return render_template('conversation.html', messages=messages, other_user=other_user)
+    cursor = request.args.get('before')
+    messages, older_cursor = conversation_page(current_user.id, user_id, cursor=cursor, per_page=MESSAGES_PER_PAGE)
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'messages': [serialize_message(message) for message in messages], 'older_cursor': older_cursor})
+    if not cursor and mark_conversation_read(current_user.id, user_id):
+        invalidate_unread('messages', current_user.id)
+    # Only the newest page keeps polling for replies
+    last_id = messages[-1].id if messages else 0
+    return render_template('conversation.html', messages=messages, other_user=other_user,
+                           older_cursor=older_cursor, last_id=None if cursor else last_id)
+
+@main.route('/conversation/<int:user_id>/messages')
+@login_required
+def conversation_updates(user_id):
+    """
+    Long-poll for messages newer than ?since=<id>. Waits up to
+    MESSAGE_POLL_TIMEOUT seconds for one to arrive when there are none yet,
+    unless MESSAGE_POLL_MAX_WAITERS requests are already waiting, in which
+    case the client is told to poll again after retry_after seconds.
+    """
+    since = request.args.get('since', 0, type=int)
+    broker = message_broker()
+    version = broker.version(current_user.id)
+    messages = messages_since(current_user.id, user_id, since)
+    timeout = current_app.config.get('MESSAGE_POLL_TIMEOUT', 25)
+    if not messages and timeout:
+        # Hand the connection back to the pool while this request sleeps
+        db.session.close()
+        moved = broker.wait(current_user.id, version, timeout)
+        if moved is None:
+            return jsonify({'messages': [], 'last_id': since, 'retry_after': MESSAGE_POLL_RETRY_SECONDS})
+        if moved:
+            messages = messages_since(current_user.id, user_id, since)
+    if any(message.recipient_id == current_user.id and not message.read for message in messages):
+        if mark_conversation_read(current_user.id, user_id):
+            invalidate_unread('messages', current_user.id)
+    return jsonify({'messages': [serialize_message(message) for message in messages],
+                    'last_id': messages[-1].id if messages else since})
 
 @main.route('/friends')
 @login_required
 def friends():
-    following = Friendship.query.filter_by(follower_id=current_user.id).all()
-    followers = Friendship.query.filter_by(followed_id=current_user.id).all()
-    all_users = User.query.filter(User.id != current_user.id).all()
-    return render_template('friends.html', following=following, followers=followers, all_users=all_users)
+    following = Friendship.query.filter_by(follower_id=current_user.id).options(joinedload(Friendship.followed)).all()
+    followers = Friendship.query.filter_by(followed_id=current_user.id).options(joinedload(Friendship.follower)).all()
+    page = max(request.args.get('page', 1, type=int), 1)
+    suggestions, has_next = suggestions_page(current_user.id, page=page, per_page=SUGGESTIONS_PER_PAGE)
+    return render_template('friends.html', following=following, followers=followers,
+                           suggestions=suggestions, page=page, has_next=has_next)
 
 @main.route('/manage_users')
 @login_required
@@ -206,8 +340,28 @@ def moderate_posts():
     if current_user.role not in ['Manager', 'Admin']:
         flash('Unauthorized access', 'danger')
         return redirect(url_for('main.dashboard'))
-    posts = Post.query.order_by(Post.date_posted.desc()).all()
-    return render_template('moderate_posts.html', posts=posts)
+    query = Post.query.options(joinedload(Post.author), defer(Post.content), defer(Post.content_html))
+    posts, next_cursor = keyset_page(query, Post.date_posted, Post.id,
+                                     cursor=request.args.get('cursor'), per_page=MODERATION_PER_PAGE)
+    return render_template('moderate_posts.html', posts=posts, next_cursor=next_cursor)
+
+@main.route('/moderate_posts/delete', methods=['POST'])
+@login_required
+def bulk_delete_posts():
+    if current_user.role not in ['Manager', 'Admin']:
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('main.dashboard'))
+    post_ids = request.form.getlist('post_ids', type=int)
+    deleted = delete_posts(current_user, post_ids)
+    resolve_reports(post_ids=deleted)
+    db.session.commit()
+    request_sweep()
+    logger.info(f"{len(deleted)} posts deleted by {current_user.role} {current_user.username}")
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'deleted': deleted})
+    skipped = len(set(post_ids)) - len(deleted)
+    flash(f'Deleted {len(deleted)} posts.' + (f' {skipped} could not be deleted.' if skipped else ''), 'success')
+    return redirect(request.referrer or url_for('main.moderate_posts'))
 
 @main.route('/report/post/<int:post_id>', methods=['POST'])
 @login_required
@@ -249,21 +403,48 @@ def report_user(user_id):
     flash('User reported successfully.', 'success')
     return redirect(url_for('main.profile', user_id=user_id))
 
-from sqlalchemy.orm import aliased
-
 @main.route('/view_reports')
 @login_required
 def view_reports():
     if current_user.role not in ['Manager', 'Admin']:
         flash('Unauthorized access', 'danger')
         return redirect(url_for('main.dashboard'))
-    User2 = aliased(User)
-    reports = db.session.query(
-        Report,
-        User.username.label('reported_username'),
-        User2.username.label('reporter_username')
-    ).join(User, Report.reported_user_id == User.id).join(User2, Report.reporter_user_id == User2.id).all()
-    return render_template('view_reports.html', reports=reports)
+    status = request.args.get('status', 'Pending')
+    if status not in REPORT_STATUSES:
+        status = 'Pending'
+    reports, next_cursor = report_queue(status, cursor=request.args.get('cursor'), per_page=MODERATION_PER_PAGE)
+    # The most reported posts and users head the first page only
+    groups = [] if request.args.get('cursor') else report_groups(status, limit=REPORT_GROUPS_SHOWN)
+    return render_template('view_reports.html', reports=reports, next_cursor=next_cursor, status=status,
+                           statuses=REPORT_STATUSES, counts=status_counts(), groups=groups)
+
+@main.route('/reports/bulk', methods=['POST'])
+@login_required
+def bulk_reports():
+    if current_user.role not in ['Manager', 'Admin']:
+        flash('Unauthorized access', 'danger')
+        return redirect(url_for('main.dashboard'))
+    report_ids = request.form.getlist('report_ids', type=int)
+    post_ids = request.form.getlist('post_ids', type=int)
+    user_ids = request.form.getlist('user_ids', type=int)
+    if report_ids:
+        # Acting on individual reports also covers the posts they are about
+        post_ids += [post_id for (post_id,) in db.session.query(Report.post_id)
+                     .filter(Report.id.in_(report_ids), Report.post_id.isnot(None))]
+    deleted = []
+    if request.form.get('action') == 'delete_posts':
+        # Only reports about posts that were deleted get resolved; the rest stay pending
+        deleted = post_ids = delete_posts(current_user, post_ids)
+        report_ids = []
+    resolved = resolve_reports(report_ids=report_ids, post_ids=post_ids, user_ids=user_ids)
+    db.session.commit()
+    if deleted:
+        request_sweep()
+    logger.info(f"{current_user.username} resolved {resolved} reports and deleted {len(deleted)} posts")
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'resolved': resolved, 'deleted': deleted})
+    flash(f'Resolved {resolved} reports' + (f' and deleted {len(deleted)} posts.' if deleted else '.'), 'success')
+    return redirect(request.referrer or url_for('main.view_reports'))
 
 @main.route('/follow/<int:user_id>')
 @login_required
@@ -272,112 +453,82 @@ def follow(user_id):
     if user.id == current_user.id:
         flash('Cannot follow yourself', 'danger')
         return redirect(url_for('main.friends'))
-    friendship = Friendship.query.filter_by(follower_id=current_user.id, followed_id=user_id).first()
-    if not friendship:
-        friendship = Friendship(follower_id=current_user.id, followed_id=user_id)
-        db.session.add(friendship)
-        db.session.commit()
-        create_notification(user_id, f"{current_user.username} started following you")
-        flash(f'You are now following {user.username}', 'success')
+    if not is_following(current_user.id, user_id):
+        try:
+            db.session.add(Friendship(follower_id=current_user.id, followed_id=user_id))
+            db.session.flush()
+            increment(User, current_user.id, following_count=1)
+            increment(User, user_id, followers_count=1)
+            backfill_timeline(current_user.id, user)
+            db.session.commit()
+            invalidate_suggestions(current_user.id)
+        except IntegrityError:
+            # A concurrent request already created this follow
+            db.session.rollback()
+        else:
+            create_notification(user_id, f"{current_user.username} started following you")
+            flash(f'You are now following {user.username}', 'success')
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'status': 'success'})
     return redirect(url_for('main.friends'))
 
 import logging
-import os
 
 logger = logging.getLogger(__name__)
 
+def remove_account(user):
+    if delete_account(user.id):
+        logger.info(f"User {user.username} queued for deletion by {current_user.username}")
+        flash(f'User {user.username} is being deleted. Their posts will disappear over the next few minutes.', 'success')
+    else:
+        logger.info(f"User {user.username} deleted by {current_user.username}")
+        flash(f'User {user.username} deleted.', 'success')
+
 @main.route('/user/delete/<int:user_id>', methods=['POST'])
 @login_required
 def delete_user(user_id):
     user_to_delete = User.query.get_or_404(user_id)
     if current_user.role == 'Manager':
         if user_to_delete.role != 'Manager':
-            # Delete profile picture file if not default
-            if user_to_delete.profile_picture and user_to_delete.profile_picture != 'default.jpg':
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], user_to_delete.profile_picture))
-                except Exception as e:
-                    logger.error(f"Error deleting profile picture: {e}")
-            db.session.delete(user_to_delete)
-            db.session.commit()
-            logger.info(f"User {user_to_delete.username} deleted by {current_user.username}")
-            flash(f'User {user_to_delete.username} deleted.', 'success')
+            remove_account(user_to_delete)
         else:
             flash('Managers cannot delete other Managers.', 'danger')
     elif current_user.role == 'Admin':
         if user_to_delete.role == 'User':
-            if user_to_delete.profile_picture and user_to_delete.profile_picture != 'default.jpg':
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], user_to_delete.profile_picture))
-                except Exception as e:
-                    logger.error(f"Error deleting profile picture: {e}")
-            db.session.delete(user_to_delete)
-            db.session.commit()
-            logger.info(f"User {user_to_delete.username} deleted by {current_user.username}")
-            flash(f'User {user_to_delete.username} deleted.', 'success')
+            remove_account(user_to_delete)
         else:
             flash('Admins can only delete Users.', 'danger')
     else:
         flash('You do not have permission to delete users.', 'danger')
     return redirect(url_for('main.dashboard'))
 
+def remove_post(post):
+    purge_posts([post])
+    db.session.commit()
+    request_sweep()
+
 @main.route('/post/delete/<int:post_id>', methods=['POST'])
 @login_required
 def delete_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = db.session.query(*POST_COLUMNS, User.role.label('author_role')).join(User, User.id == Post.user_id) \
+        .filter(Post.id == post_id).first_or_404()
     if current_user.role == 'Manager':
-        # Delete associated files
-        if post.image:
-            try:
-                os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], post.image))
-            except Exception as e:
-                logger.error(f"Error deleting post image: {e}")
-        if post.video:
-            try:
-                os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], post.video))
-            except Exception as e:
-                logger.error(f"Error deleting post video: {e}")
         # Manager can delete any post
-        db.session.delete(post)
-        db.session.commit()
+        remove_post(post)
         logger.info(f"Post {post.id} deleted by Manager {current_user.username}")
         flash('Post deleted by Manager.', 'success')
     elif current_user.role == 'Admin':
         # Admin can delete posts by Users
-        if post.author.role == 'User':
-            if post.image:
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], post.image))
-                except Exception as e:
-                    logger.error(f"Error deleting post image: {e}")
-            if post.video:
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], post.video))
-                except Exception as e:
-                    logger.error(f"Error deleting post video: {e}")
-            db.session.delete(post)
-            db.session.commit()
+        if post.author_role == 'User':
+            remove_post(post)
             logger.info(f"Post {post.id} deleted by Admin {current_user.username}")
             flash('Post deleted by Admin.', 'success')
         else:
             flash('Admins can only delete posts by Users.', 'danger')
     elif current_user.role == 'User' or current_user.role == 'Author':
         # User and Author can delete own posts
-        if post.author.id == current_user.id:
-            if post.image:
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], post.image))
-                except Exception as e:
-                    logger.error(f"Error deleting post image: {e}")
-            if post.video:
-                try:
-                    os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], post.video))
-                except Exception as e:
-                    logger.error(f"Error deleting post video: {e}")
-            db.session.delete(post)
-            db.session.commit()
+        if post.user_id == current_user.id:
+            remove_post(post)
             logger.info(f"Post {post.id} deleted by User {current_user.username}")
             flash('Your post has been deleted.', 'success')
         else:
@@ -407,7 +558,11 @@ def create_admin():
         if existing_user_username:
             flash('Username already taken. Please choose a different username.', 'danger')
             return redirect(url_for('main.create_admin'))
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        try:
+            hashed_password = hash_password(password)
+        except LoginThrottled as e:
+            flash(str(e), 'danger')
+            return render_template('create_admin.html'), 429, {'Retry-After': str(e.retry_after)}
         new_admin = User(username=username, email=email, password=hashed_password, role='Admin')
         db.session.add(new_admin)
         db.session.commit()
@@ -418,10 +573,13 @@ def create_admin():
 @main.route('/unfollow/<int:user_id>')
 @login_required
 def unfollow(user_id):
-    friendship = Friendship.query.filter_by(follower_id=current_user.id, followed_id=user_id).first()
-    if friendship:
-        db.session.delete(friendship)
+    # Only decrement if this request is the one that removed the row
+    if Friendship.query.filter_by(follower_id=current_user.id, followed_id=user_id).delete(synchronize_session=False):
+        increment(User, current_user.id, following_count=-1)
+        increment(User, user_id, followers_count=-1)
+        trim_timeline(current_user.id, user_id)
         db.session.commit()
+        invalidate_suggestions(current_user.id)
         flash('Unfollowed user', 'success')
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         return jsonify({'status': 'success'})
@@ -430,38 +588,86 @@ def unfollow(user_id):
 @main.route('/notifications')
 @login_required
 def notifications():
-    notifications = Notification.query.filter_by(user_id=current_user.id).order_by(Notification.date_created.desc()).all()
-    for notification in notifications:
-        if not notification.read:
-            notification.read = True
+    # Plain rows rather than ORM objects, so the bulk UPDATE below doesn't expire them before rendering
+    query = db.session.query(Notification.id, Notification.content, Notification.date_created, Notification.read) \
+        .filter(Notification.user_id == current_user.id)
+    notifications, next_cursor = keyset_page(query, Notification.date_created, Notification.id,
+                                             cursor=request.args.get('cursor'), per_page=NOTIFICATIONS_PER_PAGE)
+    Notification.query.filter_by(user_id=current_user.id, read=False) \
+        .update({Notification.read: True}, synchronize_session=False)
     db.session.commit()
-    return render_template('notifications.html', notifications=notifications)
+    reset_unread('notifications', current_user.id)
+    return render_template('notifications.html', notifications=notifications, next_cursor=next_cursor)
+
+@main.route('/media/<path:filename>')
+def media(filename):
+    if filename.startswith('.'):
+        abort(404)
+    # send_from_directory answers If-None-Match/If-Modified-Since with 304 and
+    # Range/If-Range with 206, and full files go through the server's
+    # wsgi.file_wrapper, which gunicorn sends with sendfile()
+    if is_content_addressed(filename):
+        # Content-addressed names never change meaning, so browsers can keep them forever, and
+        # the digest in the name is a strong ETag that is the same on every server
+        digest = filename.rsplit('/', 1)[1].split('.', 1)[0]
+        response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, max_age=MEDIA_CACHE_SECONDS,
+                                       etag=digest)
+        response.headers['Cache-Control'] = f'public, max-age={MEDIA_CACHE_SECONDS}, immutable'
+        return response
+    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, max_age=LEGACY_MEDIA_CACHE_SECONDS)
+
+@main.route('/assets/<path:filename>')
+def asset(filename):
+    # Built assets carry a content hash in their name, so they never change
+    return send_asset(filename, max_age=MEDIA_CACHE_SECONDS)
+
+@main.route('/unread_counts')
+@login_required
+def unread_counts_json():
+    counts = unread_counts(current_user.id)
+    response = jsonify(counts)
+    response.set_etag(f"{counts['notifications']}-{counts['messages']}")
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 @main.route('/profile/<int:user_id>')
+@cached_page(lambda user_id: [f'user:{user_id}', 'users'])
 def profile(user_id):
     user = User.query.get_or_404(user_id)
-    posts = Post.query.filter_by(user_id=user_id).order_by(Post.date_posted.desc()).all()
-    followers_count = Friendship.query.filter_by(followed_id=user_id).count()
-    following_count = Friendship.query.filter_by(follower_id=user_id).count()
-    return render_template('profile.html', user=user, posts=posts, followers_count=followers_count, following_count=following_count)
+    query = Post.query.options(defer(Post.content), defer(Post.content_html)).filter_by(user_id=user_id)
+    if not (current_user.is_authenticated and current_user.id == user_id):
+        query = query.filter(Post.status == 'ready')
+    posts, next_cursor = keyset_page(query, Post.date_posted, Post.id,
+                                     cursor=request.args.get('cursor'), per_page=PROFILE_POSTS_PER_PAGE)
+    following = current_user.is_authenticated and user_id != current_user.id and is_following(current_user.id, user_id)
+    return render_template('profile.html', user=user, posts=posts, next_cursor=next_cursor, following=following)
 
 @main.route('/profile/edit', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
+    # current_user is a cached read-only copy, so changes go through the row itself
+    user = db.session.get(User, current_user.id)
     if request.method == 'POST':
-        bio = bleach.clean(request.form.get('bio', '')[:200])
-        theme = request.form.get('theme', 'light')
-        profile_picture = request.files.get('profile_picture')
-
-        if profile_picture and allowed_file(profile_picture.filename):
-            filename = secure_filename(profile_picture.filename)
-            profile_picture.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-            current_user.profile_picture = filename
-
-        current_user.bio = bio
-        current_user.theme = theme
+        try:
+            form, uploads = read_upload_form({'profile_picture': MAX_IMAGE_SIZE}, ALLOWED_EXTENSIONS)
+        except UploadTooLarge as e:
+            flash(f'Profile picture must be {e.limit // (1024 * 1024)}MB or less.', 'danger')
+            return redirect(url_for('main.edit_profile'))
+        bio = clean(form.get('bio', '')[:200])
+        theme = form.get('theme', 'light')
+
+        if 'profile_picture' in uploads:
+            old_picture = user.profile_picture
+            user.profile_picture = uploads['profile_picture'].commit()
+            if old_picture != user.profile_picture:
+                release_many([old_picture])
+
+        user.bio = bio
+        user.theme = theme
         db.session.commit()
+        if 'profile_picture' in uploads:
+            request_sweep()
         flash('Profile updated!', 'success')
-        return redirect(url_for('main.profile', user_id=current_user.id))
+        return redirect(url_for('main.profile', user_id=user.id))
 
-    return render_template('edit_profile.html', user=current_user)
+    return render_template('edit_profile.html', user=user)
@@ -0,0 +1,25 @@
+def clean(text):
+    """
+    bleach.clean(). bleach and its vendored html5lib take longer to import
+    than the rest of the app's dependencies, so they are loaded on first use.
+    """
+    import bleach
+    return bleach.clean(text)
+
+EXCERPT_LENGTH = 200
+
+def make_excerpt(text):
+    """The start of a post body as shown in feeds and lists."""
+    return text[:EXCERPT_LENGTH] + ('...' if len(text) > EXCERPT_LENGTH else '')
+
+def plain_text(text):
+    """Sanitized text with its tags removed and entities decoded, as search indexes it."""
+    from markupsafe import Markup
+    return str(Markup(text).striptags())
+
+def render_content(text):
+    """
+    A post body as the HTML its page shows. It is sanitized here rather than
+    trusted from the caller, so rows written without clean() are safe too.
+    """
+    return clean(text)
@@ -0,0 +1,40 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from app import db
+
+logger = logging.getLogger(__name__)
+
+def add_column(table, column):
+    column_type = column.type.compile(dialect=db.engine.dialect)
+    ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+    if column.server_default is not None:
+        default = column.server_default.arg
+        default = default.text if hasattr(default, 'text') else "'" + default.replace("'", "''") + "'"
+        ddl += f" DEFAULT {default}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    with db.engine.begin() as conn:
+        conn.execute(text(ddl))
+
+def upgrade_schema():
+    """
+    Brings an existing database up to date with the models.
+    db.create_all() only creates missing tables, so columns and indexes
+    added to tables that already exist are created here.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                add_column(table, column)
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                try:
+                    index.create(db.engine)
+                except IntegrityError:
+                    # Unique indexes can't be built over duplicate rows; reconcile-counters removes them
+                    logger.warning(f"Could not create unique index {index.name}, run 'flask reconcile-counters'")
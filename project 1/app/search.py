@@ -0,0 +1,145 @@
+import logging
+import re
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import defer, joinedload
+from app import db
+from app.models import Post, User
+
+logger = logging.getLogger(__name__)
+
+# Private-use markers handed to snippet() so highlighting survives HTML escaping
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+
+POST_FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+        title_text, body_text, content='post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_fts(rowid, title_text, body_text) VALUES (new.id, new.title_text, new.body_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title_text, body_text)
+        VALUES ('delete', old.id, old.title_text, old.body_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title_text, body_text ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title_text, body_text)
+        VALUES ('delete', old.id, old.title_text, old.body_text);
+        INSERT INTO post_fts(rowid, title_text, body_text) VALUES (new.id, new.title_text, new.body_text);
+    END""",
+]
+
+# Underscores separate tokens, so "doe" finds john_doe as the LIKE fallback does
+USER_FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5(
+        username, content='user', content_rowid='id', tokenize='unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON "user" BEGIN
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_fts_update AFTER UPDATE OF username ON "user" BEGIN
+        INSERT INTO user_fts(user_fts, rowid, username) VALUES ('delete', old.id, old.username);
+        INSERT INTO user_fts(rowid, username) VALUES (new.id, new.username);
+    END""",
+]
+
+FTS_SCHEMA = POST_FTS_SCHEMA + USER_FTS_SCHEMA
+
+def fts_enabled():
+    return current_app.extensions.get('search_fts', False)
+
+def search_index_exists():
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.connect() as conn:
+        return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'post_fts'")).first() is not None
+
+def init_search_index(schema=FTS_SCHEMA):
+    """
+    Creates the FTS5 tables and the triggers that keep them in sync with
+    post and user. Returns False when the database can't support FTS5,
+    in which case search falls back to LIKE scans. Migrations pass the
+    schema they shipped with.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with db.engine.begin() as conn:
+            created = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'post_fts'")).first() is None
+            for statement in schema:
+                conn.execute(text(statement))
+    except OperationalError as e:
+        logger.warning(f"Full-text search unavailable, falling back to LIKE: {e}")
+        return False
+    if created:
+        rebuild_search_index()
+    return True
+
+def rebuild_search_index():
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO post_fts(post_fts) VALUES ('rebuild')"))
+        conn.execute(text("INSERT INTO user_fts(user_fts) VALUES ('rebuild')"))
+
+def recreate_search_table(name, schema):
+    """Drops an FTS table and its triggers and builds them again from schema, e.g. after a column or tokenizer change."""
+    if not search_index_exists():
+        return
+    with db.engine.begin() as conn:
+        for operation in ('insert', 'delete', 'update'):
+            conn.execute(text(f'DROP TRIGGER IF EXISTS {name}_{operation}'))
+        conn.execute(text(f'DROP TABLE IF EXISTS {name}'))
+        for statement in schema:
+            conn.execute(text(statement))
+        conn.execute(text(f"INSERT INTO {name}({name}) VALUES ('rebuild')"))
+
+def match_expression(query):
+    """Turns free text into an FTS5 query of quoted prefix terms, so user input can't inject syntax."""
+    terms = re.findall(r'\w+', query)
+    return ' '.join('"' + term + '"*' for term in terms)
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+def search_posts(query, page=1, per_page=20):
+    """
+    Returns (posts, snippets, has_next) for one page of BM25-ranked matches.
+    Titles weigh ten times the body; snippets maps post id to highlighted markup.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return [], {}, False
+    if not fts_enabled():
+        posts = Post.query.options(joinedload(Post.author), defer(Post.content), defer(Post.content_html)).filter(
+            Post.title_text.ilike(f'%{query}%') | Post.body_text.ilike(f'%{query}%'), Post.status == 'ready'
+        ).order_by(Post.date_posted.desc()).offset((page - 1) * per_page).limit(per_page + 1).all()
+        return posts[:per_page], {}, len(posts) > per_page
+
+    rows = db.session.execute(text(
+        "SELECT rowid, snippet(post_fts, 1, :start, :end, '...', 24) FROM post_fts "
+        "WHERE post_fts MATCH :expression ORDER BY bm25(post_fts, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+    ), {'start': MARK_START, 'end': MARK_END, 'expression': expression,
+        'limit': per_page + 1, 'offset': (page - 1) * per_page}).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    by_id = {post.id: post for post in Post.query.options(joinedload(Post.author), defer(Post.content),
+                                                          defer(Post.content_html))
+             .filter(Post.id.in_([row[0] for row in rows]), Post.status == 'ready')}
+    posts = [by_id[row[0]] for row in rows if row[0] in by_id]
+    snippets = {row[0]: highlight(row[1]) for row in rows}
+    return posts, snippets, has_next
+
+def search_users(query, limit=20):
+    expression = match_expression(query)
+    if not expression:
+        return []
+    if not fts_enabled():
+        return User.query.filter(User.username.ilike(f'%{query}%')).limit(limit).all()
+    ids = [row[0] for row in db.session.execute(text(
+        "SELECT rowid FROM user_fts WHERE user_fts MATCH :expression ORDER BY bm25(user_fts) LIMIT :limit"
+    ), {'expression': expression, 'limit': limit})]
+    by_id = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+    return [by_id[user_id] for user_id in ids if user_id in by_id]
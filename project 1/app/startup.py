@@ -0,0 +1,45 @@
+import os
+import time
+from jinja2 import FileSystemBytecodeCache
+
+class StartupTimer:
+    """Records how long each phase of create_app() takes."""
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.phases = []
+
+    def add(self, phase, seconds):
+        self.phases.append((phase, seconds))
+
+    def mark(self, phase):
+        """Ends phase, which ran from the previous mark (or the start) until now."""
+        now = time.perf_counter()
+        self.add(phase, now - self.last)
+        self.last = now
+
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self):
+        phases = ', '.join(f'{phase} {seconds * 1000:.0f}ms' for phase, seconds in self.phases)
+        return f"Started in {self.total() * 1000:.0f}ms: {phases}"
+
+def init_template_cache(app):
+    """
+    Keeps compiled templates in JINJA_BYTECODE_CACHE_DIR so worker processes
+    load them instead of compiling every template from source. Entries are
+    keyed by a checksum of the template source, so edits are picked up.
+    """
+    folder = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if not folder:
+        return
+    os.makedirs(folder, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(folder)
+
+def warm_templates(app):
+    """Loads every template into the environment's cache. Returns the number loaded."""
+    names = app.jinja_env.list_templates(extensions=('html',))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -1,4 +1,4 @@
-// document.addEventListener('DOMContentLoaded', () => {
+document.addEventListener('DOMContentLoaded', () => {
 //     const videoInput = document.querySelector('input[type="file"][accept="video/*"]');
 //     if (videoInput) {
 //         videoInput.addEventListener('change', (e) => {
@@ -124,4 +124,285 @@
             });
         });
     }
+
+    // Infinite scroll for the home feed: fetch the next keyset page when the sentinel comes into view
+    const feedMore = document.querySelector('.feed-more');
+    const postsContainer = document.querySelector('.posts-container');
+    if (feedMore && postsContainer && 'IntersectionObserver' in window) {
+        let loading = false;
+        const buildPostCard = (post) => {
+            const card = document.createElement('div');
+            card.classList.add('post-card');
+            card.innerHTML = `
+                <h2><a></a></h2>
+                <div class="post-meta">
+                    <img alt="Profile" class="profile-pic-small">
+                    <a></a>
+                    <span class="post-date"></span>
+                </div>
+                <div class="post-excerpt"></div>
+            `;
+            const titleLink = card.querySelector('h2 a');
+            titleLink.href = post.url;
+            titleLink.textContent = post.title;
+            card.querySelector('.post-meta img').src = post.author_profile_picture;
+            const authorLink = card.querySelector('.post-meta a');
+            authorLink.href = post.author_url;
+            authorLink.textContent = post.author_username;
+            card.querySelector('.post-date').textContent = post.date_posted;
+            card.querySelector('.post-excerpt').textContent = post.excerpt;
+            if (post.image) {
+                const picture = document.createElement('picture');
+                if (post.image_webp) {
+                    const webp = document.createElement('source');
+                    webp.srcset = post.image_webp;
+                    webp.type = 'image/webp';
+                    picture.appendChild(webp);
+                }
+                const image = document.createElement('img');
+                image.src = post.image;
+                image.alt = 'Post Image';
+                image.loading = 'lazy';
+                image.classList.add('post-image');
+                picture.appendChild(image);
+                card.appendChild(picture);
+            }
+            if (post.video) {
+                const video = document.createElement('video');
+                video.controls = true;
+                video.preload = 'none';
+                if (post.poster) video.poster = post.poster;
+                video.classList.add('post-video');
+                const source = document.createElement('source');
+                source.src = post.video;
+                source.type = 'video/mp4';
+                video.appendChild(source);
+                card.appendChild(video);
+            }
+            return card;
+        };
+        const observer = new IntersectionObserver((entries) => {
+            const cursor = feedMore.getAttribute('data-next-cursor');
+            const feedUrl = feedMore.getAttribute('data-feed-url') || '/';
+            if (!entries.some(entry => entry.isIntersecting) || loading || !cursor) return;
+            loading = true;
+            fetch(`${feedUrl}?cursor=${encodeURIComponent(cursor)}`, {
+                method: 'GET',
+                headers: {
+                    'X-Requested-With': 'XMLHttpRequest'
+                }
+            }).then(response => response.ok ? response.json() : Promise.reject())
+              .then(data => {
+                  data.posts.forEach(post => postsContainer.appendChild(buildPostCard(post)));
+                  if (data.next_cursor) {
+                      feedMore.setAttribute('data-next-cursor', data.next_cursor);
+                      feedMore.querySelector('a').href = `${feedUrl}?cursor=${encodeURIComponent(data.next_cursor)}`;
+                  } else {
+                      observer.disconnect();
+                      feedMore.remove();
+                  }
+              })
+              .catch(() => {})
+              .finally(() => { loading = false; });
+        });
+        observer.observe(feedMore);
+    }
+
+    // Recipient typeahead for the inbox: suggest usernames as the user types
+    const typeaheadInput = document.querySelector('.user-typeahead');
+    if (typeaheadInput) {
+        const suggestions = document.getElementById(typeaheadInput.getAttribute('list'));
+        const recipientId = document.getElementById('recipient_id');
+        let debounce = null;
+        typeaheadInput.addEventListener('input', () => {
+            const match = Array.from(suggestions.options).find(option => option.value === typeaheadInput.value);
+            recipientId.value = match ? match.getAttribute('data-id') : '';
+            clearTimeout(debounce);
+            const query = typeaheadInput.value.trim();
+            if (!query || match) return;
+            debounce = setTimeout(() => {
+                fetch(`/users/typeahead?q=${encodeURIComponent(query)}`, {
+                    headers: {
+                        'X-Requested-With': 'XMLHttpRequest'
+                    }
+                }).then(response => response.ok ? response.json() : [])
+                  .then(users => {
+                      suggestions.innerHTML = '';
+                      users.forEach(user => {
+                          const option = document.createElement('option');
+                          option.value = user.username;
+                          option.setAttribute('data-id', user.id);
+                          suggestions.appendChild(option);
+                      });
+                  });
+            }, 200);
+        });
+    }
+
+    // Poll unread badge counts; the endpoint answers 304 while nothing has changed
+    const badges = document.querySelectorAll('.unread-badge');
+    if (badges.length) {
+        setInterval(() => {
+            fetch('/unread_counts', {
+                headers: {
+                    'X-Requested-With': 'XMLHttpRequest'
+                }
+            }).then(response => response.ok ? response.json() : null)
+              .then(counts => {
+                  if (!counts) return;
+                  badges.forEach(badge => {
+                      const count = counts[badge.getAttribute('data-badge')];
+                      badge.textContent = count;
+                      badge.hidden = !count;
+                  });
+              });
+        }, 30000);
+    }
+
+    // "Load more" for post comments, fed by the JSON comments endpoint
+    const loadMoreComments = document.querySelector('.load-more-comments');
+    if (loadMoreComments) {
+        loadMoreComments.addEventListener('click', () => {
+            const cursor = loadMoreComments.getAttribute('data-next-cursor');
+            loadMoreComments.disabled = true;
+            fetch(`${loadMoreComments.getAttribute('data-url')}?cursor=${encodeURIComponent(cursor)}`, {
+                headers: {
+                    'X-Requested-With': 'XMLHttpRequest'
+                }
+            }).then(response => response.ok ? response.json() : Promise.reject())
+              .then(data => {
+                  const commentsSection = document.querySelector('.comments-section');
+                  data.comments.forEach(comment => {
+                      const item = document.createElement('div');
+                      item.classList.add('comment-item', 'comment-box');
+                      item.innerHTML = `
+                          <img alt="Profile" class="profile-pic-small">
+                          <a></a>: <span class="comment-text"></span> <span class="comment-date"></span>
+                      `;
+                      item.querySelector('img').src = comment.author_profile_picture;
+                      const authorLink = item.querySelector('a');
+                      authorLink.href = `/profile/${comment.author_id}`;
+                      authorLink.textContent = comment.author_username;
+                      item.querySelector('.comment-text').textContent = comment.content;
+                      item.querySelector('.comment-date').textContent = comment.date_posted;
+                      commentsSection.appendChild(item);
+                  });
+                  if (data.next_cursor) {
+                      loadMoreComments.setAttribute('data-next-cursor', data.next_cursor);
+                      loadMoreComments.disabled = false;
+                  } else {
+                      loadMoreComments.remove();
+                  }
+              })
+              .catch(() => { loadMoreComments.disabled = false; });
+        });
+    }
+
+    // Select-all checkboxes for the bulk moderation tables
+    document.querySelectorAll('.select-all').forEach(selectAll => {
+        selectAll.addEventListener('change', () => {
+            document.querySelectorAll(`input[type="checkbox"][name="${selectAll.getAttribute('data-target')}"]`)
+                .forEach(checkbox => { checkbox.checked = selectAll.checked; });
+        });
+    });
+
+    // Conversation: send without reloading, long-poll for replies and load older history
+    const messagesContainer = document.querySelector('.messages-container');
+    if (messagesContainer) {
+        const currentUserId = Number(messagesContainer.getAttribute('data-current-user-id'));
+        const seenMessages = new Set();
+        const buildMessage = (message) => {
+            const item = document.createElement('div');
+            item.classList.add('message-item', message.sender_id === currentUserId ? 'message-sent' : 'message-received');
+            item.innerHTML = `
+                <img alt="Profile" width="30" height="30" class="profile-pic">
+                <div class="message-content">
+                    <span class="message-username"></span>: <span class="message-text"></span>
+                    <span class="message-date"></span>
+                </div>
+            `;
+            item.querySelector('img').src = message.sender_profile_picture;
+            item.querySelector('.message-username').textContent = message.sender_username;
+            item.querySelector('.message-text').textContent = message.content;
+            item.querySelector('.message-date').textContent = message.date_sent;
+            return item;
+        };
+        const appendMessages = (messages) => {
+            const empty = messagesContainer.querySelector('.no-messages');
+            if (empty && messages.length) empty.remove();
+            messages.forEach(message => {
+                if (seenMessages.has(message.id)) return;
+                seenMessages.add(message.id);
+                messagesContainer.appendChild(buildMessage(message));
+            });
+        };
+
+        const pollUrl = messagesContainer.getAttribute('data-poll-url');
+        if (pollUrl) {
+            let lastId = Number(messagesContainer.getAttribute('data-last-id'));
+            const poll = () => {
+                fetch(`${pollUrl}?since=${lastId}`, {
+                    method: 'GET',
+                    headers: {
+                        'X-Requested-With': 'XMLHttpRequest'
+                    }
+                }).then(response => response.ok ? response.json() : Promise.reject())
+                  .then(data => {
+                      appendMessages(data.messages);
+                      lastId = Math.max(lastId, data.last_id);
+                      // The server sends retry_after when it has no room to hold the request open
+                      if (data.retry_after) {
+                          setTimeout(poll, data.retry_after * 1000);
+                      } else {
+                          poll();
+                      }
+                  })
+                  .catch(() => setTimeout(poll, 5000));
+            };
+            poll();
+
+            const conversationForm = document.querySelector('.conversation-form');
+            if (conversationForm) {
+                conversationForm.addEventListener('submit', (event) => {
+                    event.preventDefault();
+                    fetch(conversationForm.action, {
+                        method: 'POST',
+                        headers: {
+                            'X-Requested-With': 'XMLHttpRequest'
+                        },
+                        body: new FormData(conversationForm)
+                    }).then(response => response.ok ? response.json() : Promise.reject())
+                      .then(data => {
+                          appendMessages([data.message]);
+                          conversationForm.reset();
+                      })
+                      .catch(() => conversationForm.submit());
+                });
+            }
+        }
+
+        const loadOlder = document.querySelector('.load-older-messages');
+        if (loadOlder) {
+            loadOlder.addEventListener('click', (event) => {
+                event.preventDefault();
+                const cursor = loadOlder.getAttribute('data-cursor');
+                fetch(`${loadOlder.getAttribute('data-url')}?before=${encodeURIComponent(cursor)}`, {
+                    method: 'GET',
+                    headers: {
+                        'X-Requested-With': 'XMLHttpRequest'
+                    }
+                }).then(response => response.ok ? response.json() : Promise.reject())
+                  .then(data => {
+                      const first = messagesContainer.firstElementChild;
+                      data.messages.forEach(message => messagesContainer.insertBefore(buildMessage(message), first));
+                      if (data.older_cursor) {
+                          loadOlder.setAttribute('data-cursor', data.older_cursor);
+                      } else {
+                          loadOlder.remove();
+                      }
+                  })
+                  .catch(() => {});
+            });
+        }
+    }
 });
@@ -0,0 +1,328 @@
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from flask import current_app, url_for
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import StoredFile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_PROFILE_PICTURE = 'default.jpg'
+SWEEP_BATCH_SIZE = 500
+SWEEP_INTERVAL = 300
+ORPHAN_SCAN_INTERVAL = 24 * 3600
+# Files this new may belong to an upload whose transaction hasn't committed yet
+ORPHAN_GRACE_SECONDS = 3600
+
+def upload_folder():
+    return current_app.config['UPLOAD_FOLDER']
+
+def is_content_addressed(filename):
+    # Stored files live under two levels of shard directories, legacy uploads sit flat in the folder
+    return filename.count('/') == 2
+
+def shard_path(digest, extension):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+def temp_path():
+    folder = os.path.join(upload_folder(), '.tmp')
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, uuid.uuid4().hex)
+
+def add_reference(path, size=0):
+    """Counts one more user of path, creating its row on first use. Runs in the caller's transaction."""
+    bumped = db.session.execute(update(StoredFile).where(StoredFile.path == path)
+                                .values(refcount=StoredFile.refcount + 1)
+                                .execution_options(synchronize_session=False))
+    if bumped.rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(StoredFile(path=path, size=size, refcount=1))
+    except IntegrityError:
+        # Another request stored the same content first
+        add_reference(path, size)
+
+def commit_file(temp, digest, extension, size):
+    path = shard_path(digest, extension)
+    # Take the reference before touching the file: it holds the write lock until
+    # the caller commits, and the file is always written in case a sweep just
+    # removed an earlier copy with no references left
+    add_reference(path, size)
+    final = os.path.join(upload_folder(), path)
+    os.makedirs(os.path.dirname(final), exist_ok=True)
+    os.replace(temp, final)
+    return path
+
+class UploadTooLarge(Exception):
+    def __init__(self, limit, field=None):
+        super().__init__(f'Upload is larger than {limit} bytes')
+        self.limit = limit
+        self.field = field
+
+class PendingUpload:
+    """
+    An upload being written to a temporary file in chunks while it is
+    hashed. A write that takes it past max_bytes deletes the temporary
+    file and raises UploadTooLarge. Nothing enters the store until commit().
+    """
+
+    def __init__(self, extension, max_bytes=None, field=None):
+        self.extension = extension.lower()
+        self.max_bytes = max_bytes
+        self.field = field
+        self.temp = temp_path()
+        self.file = open(self.temp, 'wb')
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.discard()
+            raise UploadTooLarge(self.max_bytes, self.field)
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        """Adds the upload to the store in the caller's transaction and returns its stored path."""
+        self.file.close()
+        return commit_file(self.temp, self.digest.hexdigest(), self.extension, self.size)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp)
+        except OSError:
+            pass
+
+def store_upload(file_storage, extension, max_bytes=None):
+    """
+    Streams an uploaded file to disk in chunks while hashing it and stores
+    it under its SHA-256. Identical content is kept once and reference
+    counted. Returns the stored path relative to the upload folder.
+    """
+    upload = PendingUpload(extension, max_bytes)
+    try:
+        for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b''):
+            upload.write(chunk)
+    except Exception:
+        upload.discard()
+        raise
+    return upload.commit()
+
+def store_local_file(source, move=True):
+    """Adds a file that is already on disk, such as a processed media variant, to the store."""
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    temp = temp_path()
+    if move:
+        shutil.move(source, temp)
+    else:
+        shutil.copyfile(source, temp)
+    extension = source.rsplit('.', 1)[1].lower()
+    return commit_file(temp, digest.hexdigest(), extension, os.path.getsize(temp))
+
+def release_many(filenames):
+    """
+    Drops one reference per filename in bulk inside the caller's transaction,
+    leaving the files themselves for sweep_unreferenced_files(). Legacy
+    uploads get a zero-count row so the sweeper removes them too.
+    """
+    counts = {}
+    for filename in filenames:
+        if filename and filename != DEFAULT_PROFILE_PICTURE:
+            counts[filename] = counts.get(filename, 0) + 1
+    for filename, count in counts.items():
+        if is_content_addressed(filename):
+            db.session.execute(update(StoredFile).where(StoredFile.path == filename)
+                               .values(refcount=StoredFile.refcount - count)
+                               .execution_options(synchronize_session=False))
+    legacy = [filename for filename in counts if not is_content_addressed(filename)]
+    if legacy:
+        known = set(db.session.scalars(select(StoredFile.path).where(StoredFile.path.in_(legacy))))
+        rows = [{'path': filename, 'refcount': 0} for filename in legacy if filename not in known]
+        if rows:
+            db.session.execute(insert(StoredFile), rows)
+
+def sweep_unreferenced_files(batch_size=SWEEP_BATCH_SIZE):
+    """
+    Deletes stored files whose reference count reached zero. Returns the
+    number removed. Files are removed before the rows' DELETE commits, while
+    this transaction holds the write lock. An upload of the same content
+    calls add_reference() first, so it waits for that commit and then writes
+    the file again.
+    """
+    removed = 0
+    while True:
+        paths = db.session.scalars(select(StoredFile.path).where(StoredFile.refcount <= 0).limit(batch_size)).all()
+        if not paths:
+            break
+        # Rows referenced again since the SELECT are left alone
+        gone = [path for path in paths
+                if db.session.execute(delete(StoredFile).where(StoredFile.path == path, StoredFile.refcount <= 0)).rowcount]
+        for path in gone:
+            try:
+                os.remove(os.path.join(upload_folder(), path))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error deleting upload {path}: {e}")
+        db.session.commit()
+        removed += len(gone)
+    return removed
+
+def sweep_orphaned_files(grace=ORPHAN_GRACE_SECONDS, batch_size=SWEEP_BATCH_SIZE):
+    """
+    Deletes stored files that have no StoredFile row, which are left behind
+    when the transaction that referenced them rolls back, and stale
+    temporary files. Files modified in the last grace seconds are kept.
+    Returns the number removed.
+    """
+    folder = upload_folder()
+    cutoff = time.time() - grace
+    removed = 0
+    candidates = []
+
+    def remove_unknown(paths):
+        known = set(db.session.scalars(select(StoredFile.path).where(StoredFile.path.in_(paths))))
+        for path in paths:
+            if path not in known:
+                try:
+                    os.remove(os.path.join(folder, path))
+                except FileNotFoundError:
+                    continue
+                logger.info(f"Removed orphaned upload {path}")
+        return len(set(paths) - known)
+
+    for directory, _, files in os.walk(folder):
+        relative = os.path.relpath(directory, folder).replace(os.sep, '/')
+        # Only shard directories and the temp folder; legacy uploads sit flat in the folder
+        if relative != '.tmp' and relative.count('/') != 1:
+            continue
+        for name in files:
+            path = f'{relative}/{name}'
+            try:
+                if os.path.getmtime(os.path.join(folder, path)) >= cutoff:
+                    continue
+            except OSError:
+                continue
+            if relative == '.tmp':
+                try:
+                    os.remove(os.path.join(folder, path))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                continue
+            candidates.append(path)
+            if len(candidates) >= batch_size:
+                removed += remove_unknown(candidates)
+                candidates = []
+    if candidates:
+        removed += remove_unknown(candidates)
+    return removed
+
+class FileSweeper:
+    """
+    Background thread that removes unreferenced uploads, woken by
+    request_sweep() after bulk deletes and every SWEEP_INTERVAL seconds, and
+    that scans the store for orphaned files every ORPHAN_SCAN_INTERVAL.
+    Started on first use so forked workers each get their own.
+    """
+
+    def __init__(self, app, interval=SWEEP_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_orphan_scan = None
+
+    def request_sweep(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='file-sweeper', daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopping:
+                return
+            try:
+                with self.app.app_context():
+                    removed = sweep_unreferenced_files()
+                    if self.last_orphan_scan is None or time.monotonic() - self.last_orphan_scan >= ORPHAN_SCAN_INTERVAL:
+                        self.last_orphan_scan = time.monotonic()
+                        removed += sweep_orphaned_files()
+                if removed:
+                    logger.info(f"Swept {removed} unreferenced uploads")
+            except Exception as e:
+                logger.error(f"Upload sweep failed: {e}")
+
+    def shutdown(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def init_sweeper(app):
+    sweeper = FileSweeper(app)
+    app.extensions['file_sweeper'] = sweeper
+    atexit.register(sweeper.shutdown)
+
+def request_sweep():
+    current_app.extensions['file_sweeper'].request_sweep()
+
+def upload_url(filename):
+    return url_for('main.media', filename=filename)
+
+def migrate_legacy_uploads(batch_size=500):
+    """
+    Moves flat legacy uploads referenced by posts and users into the
+    content-addressed store and rewrites the rows to point at them.
+    Returns the number of legacy files migrated.
+    """
+    from app.models import Post, User
+    migrated = {}
+
+    def migrate(filename):
+        if not filename or filename == DEFAULT_PROFILE_PICTURE or is_content_addressed(filename):
+            return filename
+        if filename in migrated:
+            add_reference(migrated[filename])
+            return migrated[filename]
+        source = os.path.join(upload_folder(), filename)
+        if not os.path.exists(source):
+            return filename
+        migrated[filename] = store_local_file(source, move=False)
+        return migrated[filename]
+
+    for model, columns in ((Post, ('image', 'image_webp', 'video', 'poster')), (User, ('profile_picture',))):
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                for column in columns:
+                    setattr(row, column, migrate(getattr(row, column)))
+            db.session.commit()
+            last_id = rows[-1].id
+
+    for filename in migrated:
+        os.remove(os.path.join(upload_folder(), filename))
+    return len(migrated)
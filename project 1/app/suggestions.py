@@ -0,0 +1,106 @@
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import exists, func, select
+from sqlalchemy.orm import aliased
+from app import db
+from app.cache import DiskCache, LRUCache
+from app.models import Friendship, User
+
+# People-you-may-know: users followed by the people you follow, ranked by
+# how many of them follow each candidate. Each user's ranked list is cached
+# as (user_id, mutual_count) pairs, so a page view is one small IN query.
+
+SUGGESTIONS_LIMIT = 100
+BATCH_SIZE = 500
+
+def init_suggestions(app):
+    if app.config.get('SUGGESTIONS_CACHE_BACKEND') == 'disk':
+        backend = DiskCache(app.config['SUGGESTIONS_CACHE_DIR'], ttl=app.config.get('SUGGESTIONS_CACHE_TTL', 3600),
+                            max_bytes=app.config.get('SUGGESTIONS_CACHE_MAX_BYTES'))
+    else:
+        backend = LRUCache(maxsize=app.config.get('SUGGESTIONS_CACHE_SIZE', 10000),
+                           ttl=app.config.get('SUGGESTIONS_CACHE_TTL', 3600))
+    app.extensions['suggestions_cache'] = backend
+
+def cache_key(user_id):
+    return f'suggestions:{user_id}'
+
+def compute_suggestions(user_ids, limit=SUGGESTIONS_LIMIT):
+    """
+    Ranks friends-of-friends for each of user_ids with one grouped self-join
+    on Friendship. Users with too few mutual connections are topped up with
+    the most followed accounts. Returns {user_id: [(candidate_id, mutual), ...]}.
+    """
+    mine = aliased(Friendship)
+    theirs = aliased(Friendship)
+    already_following = exists().where(Friendship.follower_id == mine.follower_id,
+                                       Friendship.followed_id == theirs.followed_id)
+    rows = db.session.execute(
+        select(mine.follower_id, theirs.followed_id, func.count().label('mutual'), User.followers_count)
+        .join(theirs, theirs.follower_id == mine.followed_id)
+        .join(User, User.id == theirs.followed_id)
+        .where(mine.follower_id.in_(user_ids), theirs.followed_id != mine.follower_id, ~already_following)
+        .group_by(mine.follower_id, theirs.followed_id, User.followers_count)
+    )
+    ranked = defaultdict(list)
+    for user_id, candidate_id, mutual, followers in rows:
+        ranked[user_id].append((-mutual, -followers, candidate_id))
+
+    following = defaultdict(set)
+    for follower_id, followed_id in db.session.query(Friendship.follower_id, Friendship.followed_id) \
+            .filter(Friendship.follower_id.in_(user_ids)):
+        following[follower_id].add(followed_id)
+    popular = db.session.query(User.id).order_by(User.followers_count.desc(), User.id).limit(limit * 2).all()
+
+    suggestions = {}
+    for user_id in user_ids:
+        candidates = [(candidate_id, -mutual) for mutual, followers, candidate_id in sorted(ranked[user_id])[:limit]]
+        seen = {candidate_id for candidate_id, mutual in candidates} | following[user_id] | {user_id}
+        for (candidate_id,) in popular:
+            if len(candidates) >= limit:
+                break
+            if candidate_id not in seen:
+                candidates.append((candidate_id, 0))
+        suggestions[user_id] = candidates
+    return suggestions
+
+def cached_suggestions(user_id):
+    cache = current_app.extensions['suggestions_cache']
+    suggestions = cache.get(cache_key(user_id))
+    if suggestions is None:
+        suggestions = compute_suggestions([user_id])[user_id]
+        cache.set(cache_key(user_id), suggestions)
+    return suggestions
+
+def suggestions_page(user_id, page=1, per_page=20):
+    """Returns ([(user, mutual), ...], has_next) for one page of user_id's suggestions."""
+    suggestions = cached_suggestions(user_id)
+    start = (page - 1) * per_page
+    window = suggestions[start:start + per_page]
+    users = {user.id: user for user in User.query.filter(User.id.in_([candidate_id for candidate_id, mutual in window]))}
+    # Deleted users drop out here until the cached list expires
+    return [(users[candidate_id], mutual) for candidate_id, mutual in window if candidate_id in users], \
+        start + per_page < len(suggestions)
+
+def invalidate_suggestions(user_id):
+    current_app.extensions['suggestions_cache'].delete(cache_key(user_id))
+
+def recompute_suggestions(batch_size=BATCH_SIZE):
+    """
+    Recomputes and caches suggestions for every user, batch_size users per
+    query. Only useful across processes with the disk backend. Returns the
+    number of users processed.
+    """
+    cache = current_app.extensions['suggestions_cache']
+    processed = 0
+    last_id = 0
+    while True:
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.id > last_id)
+                    .order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            break
+        for user_id, suggestions in compute_suggestions(user_ids).items():
+            cache.set(cache_key(user_id), suggestions)
+        processed += len(user_ids)
+        last_id = user_ids[-1]
+    return processed
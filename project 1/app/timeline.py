@@ -0,0 +1,100 @@
+from sqlalchemy import delete, exists, func, insert, literal, select
+from sqlalchemy.orm import defer, joinedload
+from app import db
+from app.models import Friendship, Post, TimelineEntry, User
+from app.pagination import encode_cursor, keyset_page
+
+# Home timelines are fan-out-on-write: when a post goes live, one
+# INSERT ... SELECT copies it into every follower's timeline rows. Authors
+# with more than FANOUT_FOLLOWER_LIMIT followers are skipped on write and
+# merged in on read instead, as are the reader's own posts.
+
+FANOUT_FOLLOWER_LIMIT = 10000
+BACKFILL_POSTS = 50
+TIMELINE_MAX_ENTRIES = 1000
+
+def is_heavy(user):
+    return user.followers_count > FANOUT_FOLLOWER_LIMIT
+
+def fan_out_post(post):
+    """Writes a newly published post into its author's followers' timelines."""
+    if is_heavy(post.author):
+        return
+    # A follow made meanwhile may have backfilled the post already
+    already_there = exists().where(TimelineEntry.user_id == Friendship.follower_id, TimelineEntry.post_id == post.id)
+    followers = select(Friendship.follower_id, literal(post.id), literal(post.user_id), literal(post.date_posted)) \
+        .where(Friendship.followed_id == post.user_id, ~already_there)
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'post_id', 'author_id', 'date_posted'], followers))
+    db.session.commit()
+
+def backfill_timeline(user_id, author):
+    """Copies author's recent posts into user_id's timeline after a follow. Runs in the caller's transaction."""
+    if is_heavy(author):
+        return
+    already_there = exists().where(TimelineEntry.user_id == user_id, TimelineEntry.post_id == Post.id)
+    recent = select(literal(user_id), Post.id, Post.user_id, Post.date_posted) \
+        .where(Post.user_id == author.id, Post.status == 'ready', ~already_there) \
+        .order_by(Post.date_posted.desc()).limit(BACKFILL_POSTS)
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'post_id', 'author_id', 'date_posted'], recent))
+
+def trim_timeline(user_id, author_id):
+    """Removes author_id's posts from user_id's timeline after an unfollow. Runs in the caller's transaction."""
+    db.session.execute(delete(TimelineEntry).where(TimelineEntry.user_id == user_id,
+                                                   TimelineEntry.author_id == author_id))
+
+def timeline_page(user_id, cursor=None, per_page=20):
+    """
+    Returns (posts, next_cursor) for user_id's home timeline, merging the
+    stored entries with the posts of heavy authors they follow.
+    """
+    stored, stored_next = keyset_page(
+        db.session.query(TimelineEntry.date_posted, TimelineEntry.post_id).filter(TimelineEntry.user_id == user_id),
+        TimelineEntry.date_posted, TimelineEntry.post_id, cursor=cursor, per_page=per_page)
+
+    heavy_authors = select(Friendship.followed_id).join(User, User.id == Friendship.followed_id) \
+        .where(Friendship.follower_id == user_id, User.followers_count > FANOUT_FOLLOWER_LIMIT)
+    pulled, pulled_next = keyset_page(
+        db.session.query(Post.date_posted, Post.id)
+        .filter(Post.status == 'ready', (Post.user_id == user_id) | Post.user_id.in_(heavy_authors)),
+        Post.date_posted, Post.id, cursor=cursor, per_page=per_page)
+
+    # An author who crossed the limit can appear in both sources
+    merged = sorted({post_id: date for date, post_id in list(stored) + list(pulled)}.items(),
+                    key=lambda item: (item[1], item[0]), reverse=True)
+    has_more = stored_next or pulled_next or len(merged) > per_page
+    merged = merged[:per_page]
+    next_cursor = encode_cursor(merged[-1][1], merged[-1][0]) if merged and has_more else None
+
+    post_ids = [post_id for post_id, date in merged]
+    posts = {post.id: post for post in Post.query.options(joinedload(Post.author), defer(Post.content),
+                                                          defer(Post.content_html))
+             .filter(Post.id.in_(post_ids))}
+    return [posts[post_id] for post_id, date in merged if post_id in posts], next_cursor
+
+def trim_timelines(keep=TIMELINE_MAX_ENTRIES):
+    """Deletes all but the newest `keep` entries of every timeline. Returns the number of rows removed."""
+    ranked = select(TimelineEntry.id, func.row_number().over(
+        partition_by=TimelineEntry.user_id,
+        order_by=(TimelineEntry.date_posted.desc(), TimelineEntry.post_id.desc())).label('position')).subquery()
+    result = db.session.execute(delete(TimelineEntry).where(
+        TimelineEntry.id.in_(select(ranked.c.id).where(ranked.c.position > keep))))
+    db.session.commit()
+    return result.rowcount
+
+def rebuild_timelines(batch_size=500):
+    """Backfills every existing follow, e.g. after upgrading a database that had no timelines. Returns follows processed."""
+    processed = 0
+    last_id = 0
+    while True:
+        follows = Friendship.query.options(joinedload(Friendship.followed)).filter(Friendship.id > last_id) \
+            .order_by(Friendship.id).limit(batch_size).all()
+        if not follows:
+            break
+        for follow in follows:
+            backfill_timeline(follow.follower_id, follow.followed)
+        db.session.commit()
+        processed += len(follows)
+        last_id = follows[-1].id
+    return processed
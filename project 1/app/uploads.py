@@ -0,0 +1,91 @@
+from flask import abort, current_app, request
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from app.storage import CHUNK_SIZE, PendingUpload
+
+# Werkzeug parses a multipart body completely, spooling every file to a
+# temporary file, before the view runs, so a size check in the view comes
+# after the whole upload has been received. Upload views read the body
+# themselves with read_upload_form() instead, and stop at the first file
+# that goes over its cap.
+
+FORM_MEMORY_SIZE = 500 * 1024
+
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+def read_upload_form(limits, allowed_extensions, required=()):
+    """
+    Parses a multipart/form-data request body in chunks as it arrives.
+    Files in the fields named in limits are streamed into PendingUploads
+    capped at limits[field] bytes; other files, and files whose extension
+    is not in allowed_extensions, are skipped. Raises UploadTooLarge
+    without reading the rest of the body once a file passes its cap.
+    Returns (form, uploads) where uploads maps field names to
+    PendingUploads that the caller must commit() or discard(). A body
+    missing any of the required text fields is a 400.
+    """
+    if request.mimetype != 'multipart/form-data':
+        if any(name not in request.form for name in required):
+            abort(400)
+        return request.form, {}
+    boundary = request.mimetype_params.get('boundary', '').encode('latin-1')
+    if not boundary:
+        abort(400)
+    max_field_size = current_app.config.get('MAX_FORM_MEMORY_SIZE') or FORM_MEMORY_SIZE
+    decoder = MultipartDecoder(boundary, max_field_size)
+    form = MultiDict()
+    uploads = {}
+    part = upload = None
+    value = []
+    stream = request.stream
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                # An empty read marks the end of the body; the decoder raises ValueError if it was cut short
+                decoder.receive_data(stream.read(CHUNK_SIZE) or None)
+                continue
+            if isinstance(event, Epilogue):
+                break
+            if isinstance(event, Field):
+                part, upload, value = event, None, []
+            elif isinstance(event, File):
+                part, upload = event, None
+                extension = file_extension(event.filename or '')
+                if event.name in limits and extension in allowed_extensions:
+                    upload = PendingUpload(extension, limits[event.name], field=event.name)
+            elif isinstance(event, Data):
+                if isinstance(part, Field):
+                    value.append(event.data)
+                    if sum(len(data) for data in value) > max_field_size:
+                        raise RequestEntityTooLarge()
+                    if not event.more_data:
+                        form.add(part.name, b''.join(value).decode('utf-8', 'replace'))
+                elif upload is not None:
+                    upload.write(event.data)
+                    if not event.more_data:
+                        if upload.size:
+                            if part.name in uploads:
+                                uploads[part.name].discard()
+                            uploads[part.name] = upload
+                        else:
+                            upload.discard()
+                        upload = None
+    except Exception as e:
+        if upload is not None:
+            upload.discard()
+        for pending in uploads.values():
+            pending.discard()
+        if isinstance(e, ValueError):
+            abort(400)
+        raise
+    if upload is not None:
+        # A file part with no data events
+        upload.discard()
+    if any(name not in form for name in required):
+        for pending in uploads.values():
+            pending.discard()
+        abort(400)
+    return form, uploads
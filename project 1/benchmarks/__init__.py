@@ -0,0 +1,13 @@
+import os
+
+def bench_app(database, page_cache=False):
+    """
+    Creates the app against a benchmark database. Configuration comes from
+    the environment, so it is set before create_app() runs.
+    """
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(database)}'
+    os.environ['PAGE_CACHE_ENABLED'] = '1' if page_cache else '0'
+    os.environ['MEDIA_PROCESSING_ASYNC'] = '0'
+    os.environ.pop('NOTIFICATION_FANOUT_ASYNC', None)
+    from app import create_app
+    return create_app()
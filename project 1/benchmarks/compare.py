@@ -0,0 +1,33 @@
+import json
+import sys
+import click
+
+# Compares two harness reports and exits non-zero when a scenario regressed.
+
+METRICS = ('p50_ms', 'p99_ms', 'queries_per_request')
+
+@click.command()
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+@click.option('--tolerance', default=0.10, show_default=True, help='Allowed relative slowdown before failing.')
+def compare(baseline, current, tolerance):
+    """Print per-scenario changes between two benchmark reports."""
+    before = json.load(baseline)['results']
+    after = json.load(current)['results']
+    regressed = []
+    for name in sorted(set(before) & set(after)):
+        changes = []
+        for metric in METRICS:
+            old, new = before[name][metric], after[name][metric]
+            change = (new - old) / old if old else 0.0
+            changes.append(f"{metric} {old} -> {new} ({change:+.0%})")
+            # Latency is noisy, but queries per request should never grow
+            if change > (0 if metric == 'queries_per_request' else tolerance):
+                regressed.append(f"{name} {metric}")
+        click.echo(f"{name}: " + ', '.join(changes))
+    if regressed:
+        click.echo("Regressed: " + ', '.join(regressed), err=True)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    compare()
@@ -0,0 +1,124 @@
+import random
+import time
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import insert, text
+from werkzeug.security import generate_password_hash
+from benchmarks import bench_app
+
+# Populates a benchmark database with bulk inserts. The same seed and scale
+# always produce the same rows, so results from different commits compare.
+
+CHUNK_SIZE = 10000
+PASSWORD = 'benchmark'
+WORDS = ('flask', 'python', 'sqlite', 'travel', 'coffee', 'music', 'garden', 'football', 'recipe', 'photo',
+         'weekend', 'review', 'launch', 'startup', 'design', 'winter', 'summer', 'camera', 'mountain', 'ocean')
+ROLES = ('Reader', 'Reader', 'User', 'User', 'Author')
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+def random_date(rng, start, days=365):
+    return start + timedelta(seconds=rng.randrange(days * 24 * 3600))
+
+def bulk_insert(db, model, rows):
+    """Inserts rows from a generator in chunks. Returns the number inserted."""
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            db.session.execute(insert(model), chunk)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(insert(model), chunk)
+        total += len(chunk)
+    db.session.commit()
+    return total
+
+def distinct_pairs(rng, count, left, right, exclude_self=False):
+    """
+    Yields up to count distinct (left_id, right_id) pairs without keeping
+    them in memory: each left id walks the right ids from its own random offset.
+    """
+    offsets = [rng.randrange(right) for _ in range(left)]
+    for i in range(min(count, left * right)):
+        left_id = i % left
+        right_id = (offsets[left_id] + i // left) % right
+        if exclude_self and left_id == right_id:
+            continue
+        yield left_id + 1, right_id + 1
+
+@click.command()
+@click.option('--database', default='instance/bench.db', show_default=True)
+@click.option('--seed', default=1, show_default=True)
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=5000, show_default=True)
+@click.option('--comments', default=20000, show_default=True)
+@click.option('--likes', default=50000, show_default=True)
+@click.option('--follows', default=20000, show_default=True)
+@click.option('--messages', default=20000, show_default=True)
+@click.option('--notifications', default=50000, show_default=True)
+@click.option('--timelines/--no-timelines', default=True, show_default=True, help='Fill Following timelines from the follows.')
+def generate(database, seed, users, posts, comments, likes, follows, messages, notifications, timelines):
+    """Create a benchmark database with synthetic users, posts and activity."""
+    from app import db
+    from app.counters import reconcile_counters
+    from app.migrations import backfill_post_text
+    from app.models import Comment, Friendship, Like, Message, Notification, Post, User
+    from app.timeline import trim_timelines
+
+    app = bench_app(database)
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    password = generate_password_hash(PASSWORD, method='pbkdf2:sha256')
+
+    with app.app_context():
+        if User.query.first() is not None:
+            raise click.ClickException(f"{database} already has data, generate into a new file.")
+        began = time.perf_counter()
+
+        def step(name, model, rows):
+            count = bulk_insert(db, model, rows)
+            click.echo(f"{name}: {count} rows ({time.perf_counter() - began:.1f}s)")
+
+        step('users', User, ({'username': f'user{i}', 'email': f'user{i}@example.com', 'password': password,
+                             'role': rng.choice(ROLES)} for i in range(1, users + 1)))
+        step('posts', Post, ({'title': sentence(rng, 5), 'content': sentence(rng, rng.randrange(20, 200)),
+                             'user_id': rng.randrange(1, users + 1), 'date_posted': random_date(rng, start)}
+                            for _ in range(posts)))
+        # Bulk inserts skip Post's validator, so excerpts are filled in afterwards
+        backfill_post_text(batch_size=CHUNK_SIZE)
+        click.echo(f"excerpts filled ({time.perf_counter() - began:.1f}s)")
+        step('comments', Comment, ({'content': sentence(rng, rng.randrange(3, 30)), 'user_id': rng.randrange(1, users + 1),
+                                   'post_id': rng.randrange(1, posts + 1), 'date_posted': random_date(rng, start)}
+                                  for _ in range(comments)))
+        step('likes', Like, ({'user_id': user_id, 'post_id': post_id, 'is_like': rng.random() < 0.9}
+                            for user_id, post_id in distinct_pairs(rng, likes, users, posts)))
+        step('follows', Friendship, ({'follower_id': follower_id, 'followed_id': followed_id,
+                                      'date_created': random_date(rng, start)}
+                                     for follower_id, followed_id in distinct_pairs(rng, follows, users, users, True)))
+        step('messages', Message, ({'content': sentence(rng, rng.randrange(3, 20)), 'sender_id': rng.randrange(1, users + 1),
+                                   'recipient_id': rng.randrange(1, users + 1), 'date_sent': random_date(rng, start),
+                                   'read': rng.random() < 0.7}
+                                  for _ in range(messages)))
+        step('notifications', Notification, ({'user_id': rng.randrange(1, users + 1), 'content': sentence(rng, 6),
+                                              'date_created': random_date(rng, start), 'read': rng.random() < 0.7}
+                                             for _ in range(notifications)))
+
+        reconcile_counters()
+        db.session.commit()
+        click.echo(f"counters rebuilt ({time.perf_counter() - began:.1f}s)")
+        if timelines:
+            db.session.execute(text(
+                'INSERT INTO timeline_entry (user_id, post_id, author_id, date_posted) '
+                'SELECT friendship.follower_id, post.id, post.user_id, post.date_posted '
+                'FROM friendship JOIN post ON post.user_id = friendship.followed_id'))
+            db.session.commit()
+            trim_timelines()
+            click.echo(f"timelines filled ({time.perf_counter() - began:.1f}s)")
+    click.echo(f"Done. Log in as any userN@example.com with password '{PASSWORD}'.")
+
+if __name__ == '__main__':
+    generate()
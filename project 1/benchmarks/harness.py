@@ -0,0 +1,113 @@
+import json
+import random
+import resource
+import sys
+import time
+import click
+from sqlalchemy import event, func
+from benchmarks import bench_app
+
+# Drives the main routes through the Flask test client against a database
+# made by benchmarks.generate and reports latency and query counts as JSON.
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def scenarios(rng, users, posts, author_id):
+    """Each scenario is (name, logged_in_as, make_request) where make_request(client) sends one request."""
+    words = ('flask', 'coffee', 'travel mountain', 'photo review')
+    return [
+        ('index', None, lambda client: client.get('/')),
+        ('post', None, lambda client: client.get(f'/post/{rng.randrange(1, posts + 1)}')),
+        ('search', None, lambda client: client.get('/search', query_string={'query': rng.choice(words)})),
+        ('profile', None, lambda client: client.get(f'/profile/{rng.randrange(1, users + 1)}')),
+        ('inbox', author_id, lambda client: client.get('/inbox')),
+        ('like_action', author_id, lambda client: client.get(f'/like/{rng.randrange(1, posts + 1)}/like',
+                                                             headers={'X-Requested-With': 'XMLHttpRequest'})),
+        ('new_post', author_id, lambda client: client.post('/post/new', data={'title': 'Benchmark post',
+                                                                              'content': 'Posted by the benchmark harness.'})),
+    ]
+
+@click.command()
+@click.option('--database', default='instance/bench.db', show_default=True)
+@click.option('--requests', 'count', default=200, show_default=True, help='Measured requests per scenario.')
+@click.option('--warmup', default=20, show_default=True)
+@click.option('--seed', default=1, show_default=True)
+@click.option('--only', multiple=True, help='Run only the named scenarios.')
+@click.option('--page-cache/--no-page-cache', default=False, show_default=True)
+@click.option('--output', type=click.Path(), help='Write the JSON report here instead of stdout.')
+def run(database, count, warmup, seed, only, page_cache, output):
+    """Benchmark the main routes and report p50/p99 latency, queries per request and peak RSS."""
+    from app import db
+    from app.models import Post, User
+
+    app = bench_app(database, page_cache=page_cache)
+    rng = random.Random(seed)
+    queries = [0]
+    with app.app_context():
+        users = db.session.query(func.max(User.id)).scalar() or 0
+        posts = db.session.query(func.max(Post.id)).scalar() or 0
+        author = User.query.filter_by(role='Author').order_by(User.id).first()
+        if not users or not posts or author is None:
+            raise click.ClickException(f"{database} has no benchmark data, run benchmarks.generate first.")
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: queries.__setitem__(0, queries[0] + 1))
+
+    results = {}
+    for name, user_id, make_request in scenarios(rng, users, posts, author.id):
+        if only and name not in only:
+            continue
+        client = app.test_client()
+        if user_id:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+        for _ in range(warmup):
+            make_request(client)
+        timings = []
+        query_counts = []
+        errors = 0
+        for _ in range(count):
+            queries[0] = 0
+            start = time.perf_counter()
+            response = make_request(client)
+            timings.append(time.perf_counter() - start)
+            query_counts.append(queries[0])
+            if response.status_code >= 400:
+                errors += 1
+        results[name] = {
+            'requests': count,
+            'errors': errors,
+            'p50_ms': round(percentile(timings, 0.50) * 1000, 3),
+            'p99_ms': round(percentile(timings, 0.99) * 1000, 3),
+            'mean_ms': round(sum(timings) / count * 1000, 3),
+            'queries_per_request': round(sum(query_counts) / count, 2),
+            'max_queries': max(query_counts)
+        }
+        click.echo(f"{name}: p50 {results[name]['p50_ms']}ms, p99 {results[name]['p99_ms']}ms, "
+                   f"{results[name]['queries_per_request']} queries", err=True)
+
+    report = {
+        'database': database,
+        'seed': seed,
+        'page_cache': page_cache,
+        'python': sys.version.split()[0],
+        'users': users,
+        'posts': posts,
+        'results': results,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        click.echo(text)
+
+if __name__ == '__main__':
+    run()
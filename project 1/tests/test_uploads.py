@@ -0,0 +1,76 @@
+import os
+import pytest
+from flask import Flask
+from werkzeug.exceptions import BadRequest
+from app.storage import UploadTooLarge
+from app.uploads import read_upload_form
+
+BOUNDARY = 'test-boundary'
+LIMITS = {'image': 1024}
+ALLOWED_EXTENSIONS = {'png', 'jpg'}
+
+def multipart(*parts):
+    """Builds a multipart/form-data body from (name, value) fields and (name, filename, data) files."""
+    body = b''
+    for part in parts:
+        if len(part) == 2:
+            name, value = part
+            body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                     .encode() + value.encode() + b'\r\n')
+        else:
+            name, filename, data = part
+            body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = str(tmp_path)
+    return app
+
+def read(app, body, required=()):
+    with app.test_request_context('/', method='POST', data=body,
+                                  content_type=f'multipart/form-data; boundary={BOUNDARY}'):
+        return read_upload_form(LIMITS, ALLOWED_EXTENSIONS, required=required)
+
+def temp_files(app):
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], '.tmp')
+    return os.listdir(folder) if os.path.isdir(folder) else []
+
+def test_reads_fields_and_files(app):
+    form, uploads = read(app, multipart(('title', 'Hello'), ('image', 'a.png', b'x' * 100)), required=('title',))
+    assert form['title'] == 'Hello'
+    assert uploads['image'].size == 100
+    uploads['image'].discard()
+    assert temp_files(app) == []
+
+def test_file_over_its_cap_is_refused(app):
+    with pytest.raises(UploadTooLarge) as raised:
+        read(app, multipart(('title', 'Hello'), ('image', 'a.png', b'x' * 2048)))
+    assert raised.value.field == 'image'
+    assert raised.value.limit == 1024
+    assert temp_files(app) == []
+
+def test_truncated_body_is_a_bad_request(app):
+    body = multipart(('title', 'Hello'), ('image', 'a.png', b'x' * 500))
+    with pytest.raises(BadRequest):
+        read(app, body[:len(body) // 2])
+    assert temp_files(app) == []
+
+def test_missing_required_field_is_a_bad_request(app):
+    with pytest.raises(BadRequest):
+        read(app, multipart(('image', 'a.png', b'x' * 100)), required=('title',))
+    assert temp_files(app) == []
+
+def test_disallowed_extension_is_skipped(app):
+    form, uploads = read(app, multipart(('title', 'Hello'), ('image', 'a.exe', b'x' * 100)))
+    assert uploads == {}
+    assert temp_files(app) == []
+
+def test_duplicate_file_field_keeps_the_last_file(app):
+    form, uploads = read(app, multipart(('image', 'a.png', b'a' * 10), ('image', 'b.png', b'b' * 20)))
+    assert uploads['image'].size == 20
+    assert len(temp_files(app)) == 1
+    uploads['image'].discard()
+    assert temp_files(app) == []
@@ -0,0 +1,6 @@
+from app import create_app
+
+# Production entry point, e.g.:
+#   gunicorn --workers 4 --threads 4 --bind 0.0.0.0:8000 wsgi:app
+#   waitress-serve --port=8000 --threads=8 wsgi:app
+app = create_app('production')